@@ -1,17 +1,583 @@
 import argparse
+import hashlib
+import multiprocessing
 import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from pipeline import Pipeline
+from profiling import Profiler, NULL_PROFILER
+from shards import ShardWriter, INDEX_SUFFIX, recover_shards
+from image_cache import DecodeCache
+from manifest import Manifest, config_hash
+from dataset_index import DatasetIndex
+from buffers import BufferPool, MemmapPool, PingPong, NULL_POOL
+from plan import Plan, compile_plan, load_policy, quantize, resolve_policy
+from tiling import apply_tiled, bilateral_halo, kernel_halo
 from tqdm import tqdm
 from utils import *
 
 
-def save_to_disk(image, annotation, name, i_folder, a_folder):
-    cv2.imwrite(os.path.join(i_folder, name + ".jpg"), image)
-    with open(os.path.join(a_folder, name + ".txt"), "w") as f:
-        for ann in annotation:
-            f.write(" ".join(map(str, ann)) + "\n")
+WRITE_BUFFER_SIZE = 1 << 20
+OUTPUT_FORMATS = ("jpg", "png", "webp")
+FILTER_QUALITIES = ("exact", "fast")
 
 
-def main():
+def encode_settings(args):
+    """
+    :param args: Parsed augment.py arguments
+    :return: Output image extension and the cv2.imencode parameters for it
+    """
+    if args.output_format == "png":
+        return "png", [cv2.IMWRITE_PNG_COMPRESSION, args.png_compression]
+    if args.output_format == "webp":
+        return "webp", [cv2.IMWRITE_WEBP_QUALITY, args.webp_quality]
+    return "jpg", [cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality]
+
+
+def encode_sample(image, annotation, name, profiler=NULL_PROFILER, encoding=("jpg", [])):
+    ext, params = encoding
+    with profiler.stage("encode", image, item=name):
+        _, encoded = cv2.imencode("." + ext, image, params)
+        return {ext: encoded.tobytes(), "txt": format_annotations(annotation).encode()}
+
+
+def save_to_disk(image, annotation, name, i_folder, a_folder, profiler=NULL_PROFILER, encoding=("jpg", [])):
+    members = encode_sample(image, annotation, name, profiler, encoding)
+    with profiler.stage("write", item=name):
+        for ext, data in members.items():
+            folder = a_folder if ext == "txt" else i_folder
+            with open(os.path.join(folder, f"{name}.{ext}"), "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(data)
+    return members
+
+
+def unit_seed(seed, *key):
+    # Derived only from the global seed and the unit key, so results do not depend on scheduling
+    return int(np.random.SeedSequence([seed, *key]).generate_state(1)[0])
+
+
+def source_key(img_path):
+    # Keyed on the file name rather than the position in the folder, so new files don't change the others' seeds
+    name = os.path.basename(img_path)
+    return int.from_bytes(hashlib.sha1(name[:name.rfind(".")].encode()).digest()[:8], "little")
+
+
+def policy_from_args(args):
+    policy = {}
+    if args.do_rotation:
+        policy["rotation"] = {"min": args.rotate_min, "max": args.rotate_max}
+        if args.rotate_step:
+            policy["rotation"]["step"] = args.rotate_step
+    for op, enabled in (("perspective", args.perspective), ("flip", args.flip), ("bilateral", args.bilateral),
+                        ("gaussian", args.gaussian), ("hsv", args.hsv), ("contrast", args.contrast),
+                        ("sharpness", args.sharpness)):
+        if enabled:
+            policy[op] = {}
+    if args.do_shift:
+        policy["shift"] = {"min": args.shift_min, "max": args.shift_max}
+        if args.shift_step:
+            policy["shift"]["step"] = args.shift_step
+    if args.saltpepper:
+        policy["saltpepper"] = {"max": args.noise}
+    return resolve_policy(policy)
+
+
+def policy_for(args):
+    # A policy file replaces the augmentation flags
+    return load_policy(args.policy) if args.policy else policy_from_args(args)
+
+
+def sample_parameters(policy, rng):
+    params = {}
+    if "rotation" in policy:
+        low, high = policy["rotation"]["min"], policy["rotation"]["max"]
+        params["rotation"] = (float(quantize(rng.random() * (high - low) + low, policy["rotation"].get("step"))),)
+    if "perspective" in policy:
+        params["perspective"] = tuple(int(rng.random() * policy["perspective"]["max"]) for _ in range(4))
+    if "flip" in policy:
+        params["flip"] = (rng.choice(policy["flip"]["directions"]),)
+    if "bilateral" in policy:
+        bounds = policy["bilateral"]
+        params["bilateral"] = (int(rng.random() * bounds["diameter"]), int(rng.random() * bounds["sigma_color"]),
+                               int(rng.random() * bounds["sigma_space"]))
+    if "gaussian" in policy:
+        low, high = policy["gaussian"]["kernel"]
+        params["gaussian"] = (int(rng.randrange(low, high, 2)), int(rng.randrange(low, high, 2)),
+                              rng.random() * policy["gaussian"]["sigma"])
+    if "hsv" in policy:
+        (hue_low, hue_high), (sat_low, sat_high) = policy["hsv"]["hue"], policy["hsv"]["saturation"]
+        params["hsv"] = (rng.random() * (hue_high - hue_low) + hue_low, rng.random() * (sat_high - sat_low) + sat_low)
+    if "contrast" in policy:
+        params["contrast"] = (policy["contrast"]["gamma"],)
+    if "sharpness" in policy:
+        bounds = policy["sharpness"]
+        params["sharpness"] = (rng.choice(bounds["kernel_sizes"]), rng.randint(*bounds["sigma"]))
+    if "shift" in policy:
+        low, high, step = policy["shift"]["min"], policy["shift"]["max"], policy["shift"].get("step")
+        params["shift"] = (float(quantize(rng.random() * (high - low) + low, step)),
+                           float(quantize(rng.random() * (high - low) + low, step)))
+    if "saltpepper" in policy:
+        params["saltpepper"] = (rng.random() * policy["saltpepper"]["max"],)
+    return params
+
+
+STEPS = ("geometry", "bilateral", "gaussian", "photometric", "sharpness", "shift", "saltpepper")
+
+
+def apply_augmentations(new_img, new_ann, params, np_rng=None, fuse_geometry=False, profiler=NULL_PROFILER,
+                        item=None, steps=STEPS, pool=NULL_POOL, in_place=False, tiling=None, filter_quality="exact"):
+    """
+    Applies the sampled augmentations. Every op writes into a buffer from the pool and the previous
+    buffer goes back to it, new_img itself is only written to with in_place.
+    :param tiling: (tile rows, threads) to run the filters and pointwise ops tile by tile, None for whole images
+    :param filter_quality: "fast" to approximate the bilateral filter, gaussian blur and sharpening
+    :return: Augmented image, owned by the caller who may give it back to the pool, and annotations
+    """
+    chain = PingPong(new_img, pool, owned=in_place)
+    fast = filter_quality == "fast"
+
+    def filtered(op, halo, dst, *op_params):
+        # Filters and pointwise ops leave the annotations as they are, ops without a halo need the whole image
+        if tiling is None or halo is None:
+            img, _ = op(chain.current, None, *op_params, dst=dst)
+        else:
+            img = apply_tiled(lambda region: op(region, None, *op_params)[0], chain.current, halo, dst, *tiling)
+        chain.advance(img)
+
+    def stage(name, *ops):
+        return profiler.stage(name, chain.current, tuple(v for op in ops for v in params.get(op, ())), item)
+
+    def shaped(shape):
+        return shape + chain.current.shape[2:]
+
+    if "geometry" not in steps:
+        pass
+    elif fuse_geometry:
+        # Rotation, perspective, flip and shift are resampled once through the composed homography
+        if any(op in params for op in ("rotation", "perspective", "flip", "shift")):
+            with stage("geometric", "rotation", "perspective", "flip", "shift"):
+                geometry = dict(angle=params.get("rotation", (None,))[0], perspective=params.get("perspective"),
+                                flipdir=params.get("flip", (None,))[0], shift=params.get("shift"))
+                _, out_h, out_w = geometric_homography(*chain.current.shape[:2], **geometry)
+                img, new_ann = augmentate_geometric(chain.current, new_ann, **geometry,
+                                                    dst=chain.dst(shaped((out_h, out_w))))
+                chain.advance(img)
+    else:
+        if "rotation" in params:
+            with stage("rotation", "rotation"):
+                _, out_h, out_w = rotation_homography(*chain.current.shape[:2], *params["rotation"])
+                img, new_ann, _, _ = augmentate_rotation(chain.current, new_ann, *params["rotation"],
+                                                         dst=chain.dst(shaped((out_h, out_w))))
+                chain.advance(img)
+        if "perspective" in params:
+            with stage("perspective", "perspective"):
+                img, new_ann = augmentate_perspective(chain.current, new_ann, *params["perspective"], dst=chain.dst())
+                chain.advance(img)
+        if "flip" in params:
+            with stage("flip", "flip"):
+                img, new_ann = augmentate_flip(chain.current, new_ann, *params["flip"], dst=chain.dst())
+                chain.advance(img)
+    if "bilateral" in params and "bilateral" in steps:
+        with stage("bilateral", "bilateral"):
+            dist, _, sspace = params["bilateral"]
+            if fast:
+                # The approximation filters a downscaled copy, which is small enough to not need tiles
+                filtered(augmentate_bilateral_fast, None, chain.dst(), *params["bilateral"])
+            else:
+                filtered(augmentate_bilateral, bilateral_halo(dist, sspace), chain.dst(), *params["bilateral"])
+    if "gaussian" in params and "gaussian" in steps:
+        with stage("gaussian", "gaussian"):
+            kw, kh, sigma = params["gaussian"]
+            if fast:
+                filtered(augmentate_gaussianblur_fast, box_cascade_radius(kh, sigma), chain.dst(), kw, kh, sigma)
+            else:
+                filtered(augmentate_gaussianblur, kernel_halo(kw, kh, sigma), chain.dst(), kw, kh, sigma)
+    # HSV and contrast are pointwise, their lookup tables are cached and composed where possible
+    color_ops = [(op, params[op]) for op in ("hsv", "contrast") if op in params]
+    if color_ops and "photometric" in steps:
+        with stage("photometric", "hsv", "contrast"):
+            filtered(augmentate_photometric, 0, chain.inplace(), color_ops)
+    if "sharpness" in params and "sharpness" in steps:
+        with stage("sharpness", "sharpness"):
+            size, sigma = params["sharpness"]
+            sharpen = augmentate_sharpness_fast if fast else augmentate_sharpness
+            if tiling is None:
+                scratch = chain.dst()
+                img, _ = sharpen(chain.current, new_ann, size, sigma, dst=chain.inplace(), scratch=scratch)
+                chain.release(scratch)
+                chain.advance(img)
+            else:
+                # Tiles blur into tile-sized temporaries, but need the unsharpened neighbors of later tiles
+                halo = box_cascade_radius(size, sigma) if fast else kernel_halo(size, size, sigma)
+                filtered(sharpen, halo, chain.dst(), size, sigma)
+    if "shift" in params and "shift" in steps and not fuse_geometry:
+        with stage("shift", "shift"):
+            img, new_ann = augmentate_shift(chain.current, new_ann, *params["shift"], dst=chain.dst())
+            chain.advance(img)
+    if "saltpepper" in params and "saltpepper" in steps:
+        with stage("saltpepper", "saltpepper"):
+            img, new_ann = augmentate_saltnpeppernoise(chain.current, new_ann, *params["saltpepper"], rng=np_rng,
+                                                       dst=chain.inplace())
+            chain.advance(img)
+    return chain.finish(), new_ann
+
+
+# Per-process cache of the last decoded source, work units of the same image are scheduled together
+_source_cache = {}
+# Per-process pool of image buffers, shared by the pipeline threads
+_buffer_pool = BufferPool()
+
+
+def buffer_pool_for(args):
+    # Intermediates of very large images can live in memory-mapped files instead of worker memory
+    if args.tile_memmap is None:
+        return _buffer_pool
+    if "memmap_pool" not in _source_cache:
+        _source_cache["memmap_pool"] = MemmapPool(args.tile_memmap or None)
+    return _source_cache["memmap_pool"]
+
+
+def begin_job(args):
+    # Processes of augment_daemon.py serve many runs, which may read other sources, plans and caches
+    if _source_cache.get("job") != args.job:
+        _source_cache.clear()
+        _source_cache["job"] = args.job
+
+
+def tiling_for(args):
+    return (args.tile_size, args.tile_threads) if args.tile_size else None
+
+
+def decode_cache_for(args):
+    # One cache handle per process, created on first use so worker processes open their own
+    if args.decode_cache and "decode_cache" not in _source_cache:
+        _source_cache["decode_cache"] = DecodeCache(args.decode_cache, int(args.decode_cache_size * (1 << 30)))
+    return _source_cache.get("decode_cache")
+
+
+def read_image(img_path, args):
+    flags = cv2.IMREAD_COLOR
+    if args.target_size:
+        # Large JPEGs are decoded at a fraction of their size, before any op has to touch the full resolution
+        size = image_size(img_path)
+        if size is not None:
+            flags = reduced_read_flags(*size, args.target_size)
+    decode_cache = decode_cache_for(args)
+    if decode_cache is not None:
+        image = decode_cache.load(img_path, flags)
+    else:
+        image = cv2.imread(img_path, flags)
+    if image is not None and args.target_size:
+        image = downscale_image(image, args.target_size)
+    return image
+
+
+def load_source(img_path, ann_path, args, profiler=NULL_PROFILER):
+    if _source_cache.get("key") != (img_path, ann_path):
+        with profiler.stage("decode", item=img_path) as stage:
+            original_img = read_image(img_path, args)
+            original_anns = load_annotations(ann_path)
+            stage["pixels"] = original_img.shape[0] * original_img.shape[1] if original_img is not None else 0
+        _source_cache["key"] = (img_path, ann_path)
+        _source_cache["value"] = (original_img, original_anns)
+    return _source_cache["value"]
+
+
+def init_worker(cv_threads):
+    # Keep OpenCV's own thread pool from oversubscribing the cores shared with the other workers
+    cv2.setNumThreads(cv_threads)
+
+
+def output_name(img_path, aug_iter):
+    name = os.path.basename(img_path)
+    return name[:name.rfind(".")] + f"_augmented_{aug_iter}"
+
+
+def plan_for(args):
+    # Loaded once per process, worker processes read their own copy
+    if args.plan and _source_cache.get("plan_path") != args.plan:
+        _source_cache["plan"] = Plan.load(args.plan)
+        _source_cache["plan_path"] = args.plan
+    return _source_cache["plan"] if args.plan else None
+
+
+def unit_parameters(key, aug_iter, args):
+    """
+    :return: Augmentation parameters of a work unit and the seed of its noise, read from the plan if there is one
+    """
+    plan = plan_for(args)
+    if plan is not None:
+        return plan.parameters(key, aug_iter)
+    seed = unit_seed(args.seed, key, aug_iter)
+    return sample_parameters(policy_for(args), random.Random(seed)), seed
+
+
+def augment_unit(original_img, original_anns, key, aug_iter, args, profiler=NULL_PROFILER, item=None,
+                 pool=NULL_POOL):
+    params, seed = unit_parameters(key, aug_iter, args)
+
+    # The source is only read, the first op writes straight into a buffer from the pool
+    new_img, new_ann = apply_augmentations(original_img, original_anns.copy(), params, np.random.default_rng(seed),
+                                           fuse_geometry=args.fuse_geometry, profiler=profiler, item=item, pool=pool,
+                                           tiling=tiling_for(args), filter_quality=args.filter_quality)
+
+    # Drawing bounding boxes
+    if args.draw_bbox:
+        new_img = draw_annotations(new_img, new_ann, COLOR, THICKNESS)
+    return new_img, new_ann
+
+
+def finish_unit(new_img, new_ann, name, args, profiler=NULL_PROFILER):
+    result = {"records": profiler.records, "sample": None, "outputs": [], "cache": None, "bytes": 0}
+    encoding = encode_settings(args)
+    if args.output_shards:
+        # Encoded samples are small, the process collecting the results appends them to the shard writer
+        members = encode_sample(new_img, new_ann, name, profiler, encoding)
+        result["sample"] = (name, members)
+    else:
+        members = save_to_disk(new_img, new_ann, name, args.folder_images, args.folder_anns, profiler, encoding)
+        result["outputs"] = [os.path.abspath(os.path.join(args.folder_images, f"{name}.{encoding[0]}")),
+                             os.path.abspath(os.path.join(args.folder_anns, name + ".txt"))]
+    result["bytes"] = sum(len(data) for data in members.values())
+    decode_cache = decode_cache_for(args)
+    if decode_cache is not None:
+        result["cache"] = decode_cache.take_counts()
+    return result
+
+
+def augment_batch(sources, args, profiler=NULL_PROFILER, items=None):
+    """
+    Augments several sources at once, same-size images go through the photometric ops, gaussian blur
+    and salt-and-pepper noise as one stacked batch. Results are identical to augment_unit on every source.
+    :param sources: List of (original image, original annotations, source key, aug_iter) tuples
+    :param args: Parsed augment.py arguments
+    :param profiler: Profiler recording the stages
+    :param items: Output names of the sources, used in the profile
+    :return: List of (augmented image, augmented annotations) pairs
+    """
+    items = items or [None] * len(sources)
+    states = []
+    for (original_img, original_anns, key, aug_iter), item in zip(sources, items):
+        params, seed = unit_parameters(key, aug_iter, args)
+        np_rng = np.random.default_rng(seed)
+        new_img, new_ann = apply_augmentations(original_img, original_anns.copy(), params, np_rng, args.fuse_geometry,
+                                               profiler, item, steps=("geometry", "bilateral"), tiling=tiling_for(args),
+                                               filter_quality=args.filter_quality)
+        states.append([new_img, new_ann, params, np_rng])
+
+    groups = {}
+    for state in states:
+        groups.setdefault(state[0].shape, []).append(state)
+    for group in groups.values():
+        params = [state[2] for state in group]
+        label = f"batch of {len(group)}"
+        pixels = len(group) * group[0][0].shape[0] * group[0][0].shape[1]
+        with profiler.stage("stack", item=label) as stage:
+            stage["pixels"] = pixels
+            batch = np.stack([state[0] for state in group])
+        if "gaussian" in params[0]:
+            with profiler.stage("gaussian", item=label) as stage:
+                stage["pixels"] = pixels
+                batch, _ = augmentate_gaussianblur_batch(batch, None, *zip(*(p["gaussian"] for p in params)),
+                                                         fast=args.filter_quality == "fast")
+        color_ops = [[(op, p[op]) for op in ("hsv", "contrast") if op in p] for p in params]
+        if color_ops[0]:
+            with profiler.stage("photometric", item=label) as stage:
+                stage["pixels"] = pixels
+                batch, _ = augmentate_photometric_batch(batch, None, color_ops)
+        for i, state in enumerate(group):
+            # Sharpness works in place on the batch slice, shift comes back as a new image of the same size
+            new_img, state[1] = apply_augmentations(batch[i], state[1], state[2], state[3], args.fuse_geometry,
+                                                    profiler, steps=("sharpness", "shift"), in_place=True,
+                                                    filter_quality=args.filter_quality)
+            # Indexing makes a new view every time, so the buffers are compared instead of the objects
+            if not np.may_share_memory(new_img, batch):
+                batch[i] = new_img
+        if "saltpepper" in params[0]:
+            with profiler.stage("saltpepper", item=label) as stage:
+                stage["pixels"] = pixels
+                augmentate_saltnpeppernoise_batch(batch, None, [p["saltpepper"][0] for p in params],
+                                                  [state[3] for state in group], copy=False)
+        for i, state in enumerate(group):
+            state[0] = batch[i]
+
+    results = []
+    for new_img, new_ann, _, _ in states:
+        # Drawing bounding boxes
+        if args.draw_bbox:
+            new_img = draw_annotations(new_img, new_ann, COLOR, THICKNESS)
+        results.append((new_img, new_ann))
+    return results
+
+
+def process_batch(batch, args):
+    begin_job(args)
+    profiler = Profiler() if args.profile else NULL_PROFILER
+    sources, names = [], []
+    for index, img_path, ann_path, aug_iter in batch:
+        original_img, original_anns = load_source(img_path, ann_path, args, profiler)
+        sources.append((original_img, original_anns, source_key(img_path), aug_iter))
+        names.append(output_name(img_path, aug_iter))
+    augmented = augment_batch(sources, args, profiler, names)
+    done = []
+    for unit, name, (new_img, new_ann) in zip(batch, names, augmented):
+        result = finish_unit(new_img, new_ann, name, args, profiler)
+        # The profile of the whole batch travels with its first unit
+        result["records"] = () if done else profiler.records
+        done.append((unit, result))
+    return done
+
+
+def process_unit(unit, args):
+    begin_job(args)
+    index, img_path, ann_path, aug_iter = unit
+    # Each call profiles into its own recorder, whose records travel back to the parent process
+    profiler = Profiler() if args.profile else NULL_PROFILER
+    name = output_name(img_path, aug_iter)
+    original_img, original_anns = load_source(img_path, ann_path, args, profiler)
+    new_img, new_ann = augment_unit(original_img, original_anns, source_key(img_path), aug_iter, args, profiler, name,
+                                    buffer_pool_for(args))
+    result = finish_unit(new_img, new_ann, name, args, profiler)
+    buffer_pool_for(args).give(new_img)
+    return unit, result
+
+
+class RunResults:
+    """
+    Gathers the results of finished work units from workers or pipeline threads: merges the profiles,
+    writes shard samples, counts decode cache lookups and records every source whose units all finished.
+    """
+
+    def __init__(self, units, args, profiler, shard_writer=None, manifest=None, config=None):
+        self.args = args
+        self.profiler = profiler
+        self.shard_writer = shard_writer
+        self.manifest = manifest
+        self.config = config
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.completed = 0
+        self.bytes_written = 0
+        self.remaining = {}
+        self.outputs = {}
+        for index, _, _, _ in units:
+            self.remaining[index] = self.remaining.get(index, 0) + 1
+        self.lock = threading.Lock()
+
+    def collect(self, unit, result):
+        index, img_path, ann_path, _ = unit
+        outputs = list(result["outputs"])
+        if result["sample"] is not None:
+            name, members = result["sample"]
+            with self.profiler.stage("write", item=name):
+                shard = self.shard_writer.write(name, members)
+            outputs += [os.path.abspath(shard), os.path.abspath(shard + INDEX_SUFFIX)]
+        with self.lock:
+            self.profiler.merge(result["records"])
+            if result["cache"] is not None:
+                self.cache_hits += result["cache"][0]
+                self.cache_misses += result["cache"][1]
+            self.completed += 1
+            self.bytes_written += result["bytes"]
+            self.outputs.setdefault(index, []).extend(outputs)
+            self.remaining[index] -= 1
+            source_done = self.remaining[index] == 0
+        if source_done and self.manifest is not None:
+            self.manifest.record(os.path.abspath(img_path), os.path.abspath(ann_path), self.config,
+                                 self.args.seed, self.outputs.pop(index))
+
+
+def run_streaming(units, args, progress, results, profiler=NULL_PROFILER):
+    # Group the units back per image so each source is decoded once by the reader stage
+    jobs = {}
+    for unit in units:
+        jobs.setdefault(unit[0], []).append(unit)
+
+    def read(job):
+        _, img_path, ann_path, _ = job[0]
+        with profiler.stage("decode", item=img_path) as stage:
+            original_img = read_image(img_path, args)
+            original_anns = load_annotations(ann_path)
+            stage["pixels"] = original_img.shape[0] * original_img.shape[1] if original_img is not None else 0
+        for unit in job:
+            yield original_img, original_anns, unit
+
+    def augment(item):
+        original_img, original_anns, unit = item
+        _, img_path, _, aug_iter = unit
+        name = output_name(img_path, aug_iter)
+        new_img, new_ann = augment_unit(original_img, original_anns, source_key(img_path), aug_iter, args,
+                                        profiler, name, buffer_pool_for(args))
+        return new_img, new_ann, name, unit
+
+    def write(item):
+        new_img, new_ann, name, unit = item
+        # Pipeline threads share the run's profiler, so the result carries no records of its own
+        result = finish_unit(new_img, new_ann, name, args, profiler)
+        buffer_pool_for(args).give(new_img)
+        result["records"] = ()
+        results.collect(unit, result)
+        progress.update(1)
+
+    augment_threads = args.augment_threads or os.cpu_count() or 1
+    cv2.setNumThreads(args.cv_threads or max(1, (os.cpu_count() or 1) // augment_threads))
+    pipeline = Pipeline(read, augment, write, reader_threads=args.reader_threads, augment_threads=augment_threads,
+                        writer_threads=args.writer_threads, queue_depth=args.queue_depth)
+    return pipeline.run(jobs.values())
+
+
+def downscale_summary(pairs, target_size):
+    # Pixel-bound ops like the blurs, warps and noise scale with the pixel count, so its ratio is the speedup
+    source_pixels = target_pixels = known = 0
+    for img_path, _ in pairs:
+        size = image_size(img_path)
+        if size is not None:
+            known += 1
+            source_pixels += size[0] * size[1]
+            h, w = target_dims(*size, target_size)
+            target_pixels += h * w
+    if not target_pixels:
+        return f"Downscaling to {target_size} px."
+    return (f"Downscaling to {target_size} px: {target_pixels / known / 1e6:.2f} MP per image instead of "
+            f"{source_pixels / known / 1e6:.2f} MP, {source_pixels / target_pixels:.1f}x fewer pixels to augment.")
+
+
+def build_units(pairs, args):
+    # Every (image, aug_iter) pair is an independent work unit with its own seed
+    units = []
+    for index, (img_path, ann_path) in enumerate(pairs):
+        augs_for_this = args.augs
+        if args.rand_augs:
+            augs_for_this = random.Random(unit_seed(args.seed, source_key(img_path))).randint(1, args.augs)
+        for aug_iter in range(augs_for_this):
+            units.append((index, img_path, ann_path, aug_iter))
+    return units
+
+
+# Options that change how a run executes but not what it produces
+EXECUTION_OPTIONS = {"workers", "cv_threads", "pipeline", "queue_depth", "reader_threads", "augment_threads",
+                     "writer_threads", "profile", "decode_cache", "decode_cache_size", "manifest", "index_cache",
+                     "verbose", "seed", "compile_plan", "shard_index", "num_shards", "tile_size", "tile_threads",
+                     "tile_memmap", "job", "shard_size", "batch_size"}
+
+
+# Options holding paths, compared as absolute paths so any spelling of the same folder is the same run
+CONFIG_PATH_OPTIONS = ("folder_images", "folder_anns", "output_shards", "plan")
+
+
+def run_config(args, plan=None):
+    config = {k: v for k, v in vars(args).items() if k not in EXECUTION_OPTIONS}
+    for option in CONFIG_PATH_OPTIONS:
+        if config[option]:
+            config[option] = os.path.abspath(config[option])
+    # The sampling bounds come from the policy file or the flags, a plan fixes every parameter itself
+    config["policy"] = plan.digest() if plan is not None else policy_for(args)
+    return config_hash(config)
+
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--folder-images", type=str, required=False, default="./images",
                         help="The folder where image data are located. Defaults to ./images")
@@ -23,6 +589,9 @@ def main():
                         help="Minimum rotation angles. Defaults to -90")
     parser.add_argument("--rotate-max", type=float, required=False, default=90,
                         help="Maximum rotation angles. Defaults to 90")
+    parser.add_argument("--rotate-step", type=float, required=False, default=None,
+                        help="Round the rotation angles to multiples of this many degrees, so rotations repeat and "
+                             "right angles skip resampling. Not rounded if omitted")
     parser.add_argument("--perspective", action="store_true", default=False,
                         help="Use this flag to apply perspective transform to the images.")
     parser.add_argument("--flip", action="store_true", default=False,
@@ -47,6 +616,63 @@ def main():
                         help="Minimum shift in pixels. Defaults to -10")
     parser.add_argument("--shift-max", type=float, required=False, default=10,
                         help="Maximum shift in pixels. Defaults to 10")
+    parser.add_argument("--shift-step", type=float, required=False, default=None,
+                        help="Round the shifts to multiples of this many pixels, whole-pixel shifts are copied "
+                             "without resampling. Not rounded if omitted")
+    parser.add_argument("--target-size", type=int, required=False, default=None,
+                        help="Downscale the images so their longer side is this many pixels before augmenting them, "
+                             "large JPEGs are decoded at a reduced size. Keeps the original size if omitted")
+    parser.add_argument("--filter-quality", type=str, required=False, default="exact", choices=FILTER_QUALITIES,
+                        help="Use fast to approximate the bilateral filter, gaussian blur and sharpening, which is "
+                             "much faster for large filters and visually close. Defaults to exact")
+    parser.add_argument("--tile-size", type=int, required=False, default=None,
+                        help="Run the blurs, sharpening and color ops on full-width tiles of this many rows to bound "
+                             "the memory they need on very large images, with identical results. Whole images if "
+                             "omitted")
+    parser.add_argument("--tile-threads", type=int, required=False, default=1,
+                        help="Number of threads processing the tiles of an image. Defaults to 1")
+    parser.add_argument("--tile-memmap", type=str, nargs="?", required=False, default=None, const="",
+                        help="Keep the intermediate images in memory-mapped temporary files in this folder, or in the "
+                             "system temporary folder if no folder is given")
+    parser.add_argument("--output-format", type=str, required=False, default="jpg", choices=OUTPUT_FORMATS,
+                        help="Image format of the augmented images. Defaults to jpg")
+    parser.add_argument("--jpeg-quality", type=int, required=False, default=95,
+                        help="JPEG quality of the augmented images, from 0 to 100. Defaults to 95")
+    parser.add_argument("--png-compression", type=int, required=False, default=1,
+                        help="PNG compression level of the augmented images, from 0 to 9. Defaults to 1")
+    parser.add_argument("--webp-quality", type=int, required=False, default=95,
+                        help="WebP quality of the augmented images, from 1 to 100, above 100 is lossless. "
+                             "Defaults to 95")
+    parser.add_argument("--fuse-geometry", action="store_true", default=False,
+                        help="Use this flag to apply rotation, perspective, flip and shift as a single warp.")
+    parser.add_argument("--output-shards", type=str, required=False, default=None,
+                        help="Write the augmented samples into tar shards in this folder instead of loose files.")
+    parser.add_argument("--shard-size", type=float, required=False, default=1024,
+                        help="Maximum size of a shard in megabytes. Defaults to 1024")
+    parser.add_argument("--decode-cache", type=str, required=False, default=None,
+                        help="Folder to cache decoded source images in, later runs skip decoding them.")
+    parser.add_argument("--decode-cache-size", type=float, required=False, default=10,
+                        help="Maximum size of the decode cache in gigabytes. Defaults to 10")
+    parser.add_argument("--manifest", type=str, required=False, default="./augment_manifest.jsonl",
+                        help="Run manifest used to skip finished images and to clean up. Defaults to "
+                             "./augment_manifest.jsonl, pass an empty string to disable it")
+    parser.add_argument("--index-cache", type=str, required=False, default="./.dataset_index",
+                        help="Folder to cache the listings of the image and annotation folders in, for a fast start "
+                             "on large folders. Defaults to ./.dataset_index, pass an empty string to disable it")
+    parser.add_argument("--policy", type=str, required=False, default=None,
+                        help="JSON or YAML file with the augmentations to apply and their sampling bounds, replaces "
+                             "the augmentation flags.")
+    parser.add_argument("--compile-plan", type=str, required=False, default=None,
+                        help="Sample the parameters of every augmentation and save them to this plan file instead of "
+                             "augmenting.")
+    parser.add_argument("--plan", type=str, required=False, default=None,
+                        help="Augment exactly as described by a plan file from --compile-plan.")
+    parser.add_argument("--shard-index", type=int, required=False, default=0,
+                        help="Index of the slice of the images this run augments, from 0 to --num-shards - 1. "
+                             "Defaults to 0")
+    parser.add_argument("--num-shards", type=int, required=False, default=1,
+                        help="Number of slices the images are split into, to augment them on several machines. "
+                             "Defaults to 1")
     parser.add_argument("--rand-augs", action="store_true", default=False,
                         help="Use this flag to have random augmentations for each image.")
     parser.add_argument("--augs", type=int, required=False, default=1,
@@ -55,114 +681,219 @@ def main():
                         help="Use this flag to draw bounding boxes on the images at the end.")
     parser.add_argument("--verbose", action="store_true", default=False,
                         help="Use this flag to make the augmentation process verbose.")
+    parser.add_argument("--workers", type=int, required=False, default=1,
+                        help="Number of worker processes to augment with. Defaults to 1")
+    parser.add_argument("--seed", type=int, required=False, default=None,
+                        help="Global random seed, results are identical for any number of workers. Random if omitted")
+    parser.add_argument("--batch-size", type=int, required=False, default=1,
+                        help="Number of images whose photometric ops, gaussian blur and noise run as one stacked "
+                             "batch, not supported with --pipeline. Defaults to 1")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="Use this flag to overlap reading, augmenting and writing in a streaming pipeline.")
+    parser.add_argument("--queue-depth", type=int, required=False, default=8,
+                        help="Maximum number of images waiting between two pipeline stages. Defaults to 8")
+    parser.add_argument("--reader-threads", type=int, required=False, default=2,
+                        help="Number of pipeline threads decoding the source images. Defaults to 2")
+    parser.add_argument("--augment-threads", type=int, required=False, default=None,
+                        help="Number of pipeline threads augmenting the images. Defaults to the CPU count")
+    parser.add_argument("--writer-threads", type=int, required=False, default=2,
+                        help="Number of pipeline threads encoding and writing the results. Defaults to 2")
+    parser.add_argument("--profile", type=str, required=False, default=None,
+                        help="Records the time spent in every stage and saves it to this .json or .csv file.")
+    parser.add_argument("--cv-threads", type=int, required=False, default=None,
+                        help="OpenCV threads per worker. Defaults to the CPU count divided by the number of workers")
+    # Set by augment_daemon.py to tell the runs its warm processes serve apart
+    parser.set_defaults(job=None)
+    return parser
+
+
+def parse_args(argv=None):
+    """
+    :param argv: Command line arguments, sys.argv if omitted
+    :return: Parsed and checked augment.py arguments
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard-index must be between 0 and --num-shards - 1")
+    if args.num_shards > 1 and args.seed is None and args.plan is None:
+        parser.error("--num-shards needs a --seed or a --plan shared by all slices")
+    if args.plan and args.compile_plan:
+        parser.error("--compile-plan and --plan can't be used together")
+    if args.pipeline and args.batch_size > 1:
+        parser.error("--batch-size can't be used with --pipeline, which augments one image at a time")
+    return args
 
-    args = parser.parse_args()
 
-    imgs = []
-    for i in sorted(os.scandir(args.folder_images), key=lambda rf: rf.name):
-        imgs.append(i)
-    initial_image_count = len(imgs)
+@contextmanager
+def worker_pool(args, processes, pool=None):
+    # A pool handed in by the caller is kept warm for its next run
+    if pool is not None:
+        yield pool
+        return
+    cv_threads = args.cv_threads or max(1, (os.cpu_count() or 1) // processes)
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(cv_threads,)) as new_pool:
+        yield new_pool
+
+
+def run(args, pool=None, progress_bar=tqdm):
+    """
+    Augments the dataset selected by the arguments
+    :param args: Parsed augment.py arguments
+    :param pool: Worker pool to run the work units on, used instead of starting --workers processes
+    :param progress_bar: tqdm or a class with the same constructor, update and context manager
+    :return: RunResults of the run, None if it only compiled a plan
+    """
+    begin_job(args)
+    manifest = Manifest(args.manifest) if args.manifest else None
+    # Outputs of earlier runs live next to the sources, they must not be picked up as sources themselves
+    previous_outputs = manifest.outputs() if manifest is not None else set()
+
+    plan = plan_for(args)
+    if plan is not None:
+        # The plan fixes the sources and every parameter, the folders are not listed again
+        args.seed = plan.seed
+        initial_image_count = len(plan.images)
+        if args.verbose:
+            print(f"[Success] Loaded a plan of {len(plan)} augmentations of {initial_image_count} images.")
+    else:
+        index = DatasetIndex(args.folder_images, args.folder_anns, args.index_cache or None, previous_outputs)
+        initial_image_count = len(index)
+        if args.verbose:
+            print(f"[Success] Finished loading {initial_image_count} images with {index.total_boxes()} "
+                  f"bounding boxes.")
+        # Unmatched files are left out by name, they no longer shift every later image onto the wrong annotation
+        if index.missing:
+            print(f"[Warning] Skipping {len(index.missing)} images without an annotation, "
+                  f"for example {index.missing[0]}. Run fill_missing_annotations.py to add empty ones.")
+        if index.orphans and args.verbose:
+            print(f"[Warning] Ignoring {len(index.orphans)} annotations without an image, "
+                  f"for example {index.orphans[0]}.")
     curr_image_count = initial_image_count
-    if args.verbose:
-        print(f"[Success] Finished loading {initial_image_count} images.")
 
-    anns = []
-    for a in sorted(os.scandir(args.folder_anns), key=lambda rf: rf.name):
-        anns.append(a)
+    config = run_config(args, plan)
+    if args.seed is None and manifest is not None:
+        # Resuming an interrupted run needs the seed it started with
+        args.seed = manifest.seed_for(config)
+    if args.seed is None:
+        args.seed = random.randrange(2 ** 32)
     if args.verbose:
-        print(f"[Success] Finished loading {len(anns)} annotations.")
-        if initial_image_count != len(anns):
-            print("[Warning] Number of images does not match the number of annotations!")
+        print(f"[Info] Using seed {args.seed}.")
 
-    for i, a in tqdm(zip(imgs, anns), desc="Augmenting images...", total=initial_image_count):
-        fname = i.name[:i.name.rfind(".")]
+    if args.compile_plan:
+        plan = compile_plan(index.pairs, [source_key(img_path) for img_path, _ in index.pairs], policy_for(args),
+                            args.seed, args.augs, args.rand_augs)
+        plan.save(args.compile_plan)
+        print(f"[Success] Compiled a plan of {len(plan)} augmentations of {len(index)} images to {args.compile_plan}.")
+        return None
 
-        # Extract data from files and set up augmentation parameters
-        original_img = cv2.imread(i.path)
-        with open(a.path, "r") as f:
-            original_anns = [list(map(float, a.strip('\n').split(' '))) for a in f.readlines()]
+    # Slices hold whole sources, seeds and plan rows don't depend on the slice, so the outputs of all
+    # slices together are the outputs of a single run
+    if plan is not None:
+        # Plans list the paths as they were given, workers of a shared pool may run in another folder
+        units = [(source, os.path.abspath(img_path), os.path.abspath(ann_path), aug_iter)
+                 for source, img_path, ann_path, aug_iter in plan.select(args.shard_index, args.num_shards)]
+    else:
+        units = build_units(index.pairs[args.shard_index::args.num_shards], args)
+    sources = {}
+    for source, img_path, ann_path, _ in units:
+        sources.setdefault(source, (img_path, ann_path))
+    if manifest is not None:
+        done = {source for source, (img_path, ann_path) in sources.items()
+                if manifest.is_complete(os.path.abspath(img_path), os.path.abspath(ann_path), config, args.seed)}
+        remaining = [unit for unit in units if unit[0] not in done]
+        # Outputs of the skipped sources are still there and count towards the achieved images
+        curr_image_count += len(units) - len(remaining)
+        units = remaining
+        if args.verbose and done:
+            print(f"[Info] Skipping {len(done)} images already augmented according to {args.manifest}.")
+    pairs = [pair for source, pair in sources.items() if manifest is None or source not in done]
 
-        augs_for_this = args.augs
-        if args.rand_augs:
-            augs_for_this = random.randint(1, args.augs)
+    profiler = Profiler() if args.profile else NULL_PROFILER
+    shard_writer = None
+    if args.output_shards:
+        # Every slice writes its own shards, so the shard folders of all nodes can be merged as they are
+        prefix = f"augmented-{args.shard_index:04d}" if args.num_shards > 1 else "augmented"
+        if manifest is not None:
+            # A run killed before it indexed its last shard left it behind, its unfinished samples are written again
+            removed = recover_shards(args.output_shards, prefix, previous_outputs)
+            if args.verbose and removed:
+                print(f"[Info] Removed {len(removed)} shards an interrupted run left without an index.")
+        shard_writer = ShardWriter(args.output_shards, prefix, max_bytes=int(args.shard_size * (1 << 20)))
+    results = RunResults(units, args, profiler, shard_writer, manifest, config)
+    start = time.perf_counter()
+    try:
+        with progress_bar(desc="Augmenting images...", total=len(units)) as progress:
+            if args.pipeline:
+                stage_stats = run_streaming(units, args, progress, results, profiler)
+            elif args.batch_size > 1:
+                # Consecutive units mostly come from the same source, so batches are mostly made of same-size images
+                batches = [units[i:i + args.batch_size] for i in range(0, len(units), args.batch_size)]
+                if args.workers > 1 or pool is not None:
+                    with worker_pool(args, args.workers, pool) as workers:
+                        for done in workers.imap_unordered(partial(process_batch, args=args), batches):
+                            for unit, result in done:
+                                results.collect(unit, result)
+                                progress.update(1)
+                else:
+                    if args.cv_threads:
+                        cv2.setNumThreads(args.cv_threads)
+                    for batch in batches:
+                        for unit, result in process_batch(batch, args):
+                            results.collect(unit, result)
+                            progress.update(1)
+            elif args.workers > 1 or pool is not None:
+                with worker_pool(args, args.workers, pool) as workers:
+                    # Units of the same image are adjacent, so chunking by --augs lets a worker decode each image once
+                    for unit, result in workers.imap_unordered(partial(process_unit, args=args), units,
+                                                               chunksize=max(1, args.augs)):
+                        results.collect(unit, result)
+                        progress.update(1)
+            else:
+                if args.cv_threads:
+                    cv2.setNumThreads(args.cv_threads)
+                for unit in units:
+                    results.collect(*process_unit(unit, args))
+                    progress.update(1)
+    finally:
+        # An interrupted run still indexes its last shard and flushes the manifest, so it can be resumed
+        if shard_writer is not None:
+            shard_writer.close()
+        if manifest is not None:
+            manifest.close()
+    curr_image_count += results.completed
+    elapsed = time.perf_counter() - start
 
-        for aug_iter in range(augs_for_this):
-            new_img = original_img.copy()
-            new_ann = original_anns.copy()
-            for ann in new_ann:
-                ann[0] = int(ann[0])
-
-            # Rotation augmentation
-            if args.do_rotation:
-                target_angle = random.random() * (args.rotate_max - args.rotate_min) + args.rotate_min
-                new_img, new_ann, _, _ = augmentate_rotation(new_img, new_ann, target_angle)
-
-            # Perspective augmentation
-            if args.perspective:
-                target_dx1 = int(random.random() * 130)
-                target_dx2 = int(random.random() * 130)
-                target_dy1 = int(random.random() * 130)
-                target_dy2 = int(random.random() * 130)
-                new_img, new_ann = augmentate_perspective(new_img, new_ann,
-                                                          target_dx1, target_dx2, target_dy1, target_dy2)
-
-            # Flip augmentation
-            if args.flip:
-                target_flip = random.choice(["h", "v"])
-                new_img, new_ann = augmentate_flip(new_img, new_ann, target_flip)
-
-            # Bilateral Blur augmentation
-            if args.bilateral:
-                target_dist = int(random.random() * 23)
-                target_scolor = int(random.random() * 98)
-                target_sspace = int(random.random() * 88)
-                new_img, new_ann = augmentate_bilateral(new_img, new_ann, target_dist, target_scolor, target_sspace)
-
-            # Gaussian Blur augmentation
-            if args.gaussian:
-                target_kw = int(random.randrange(1, 9, 2))
-                target_kh = int(random.randrange(1, 9, 2))
-                target_sigma = random.random() * 25
-                new_img, new_ann = augmentate_gaussianblur(new_img, new_ann, target_kw, target_kh, target_sigma)
-
-            # HSV augmentation
-            if args.hsv:
-                target_dh = random.random() * 52 + 34
-                target_ds = random.random() * 2.5 + 1.2
-                new_img, new_ann = augmentate_hsv(new_img, new_ann, target_dh, target_ds)
-
-            # Contrast augmentation
-            if args.contrast:
-                target_gamma = 0.75
-                new_img, new_ann = augmentate_contrast(new_img, new_ann, target_gamma)
-
-            # Sharpness augmentation
-            if args.sharpness:
-                target_ksize = random.choice([3, 5, 7, 9, 11, 13, 17, 19, 23])
-                target_sigma = random.randint(5, 100)
-                new_img, new_ann = augmentate_sharpness(new_img, new_ann, target_ksize, target_sigma)
-
-            # Shift augmentation
-            if args.do_shift:
-                target_shift_x = random.random() * (args.shift_max - args.shift_min) + args.shift_min
-                target_shift_y = random.random() * (args.shift_max - args.shift_min) + args.shift_min
-                new_img, new_ann = augmentate_shift(new_img, new_ann, target_shift_x, target_shift_y)
-
-            # Salt and pepper noise augmentation
-            if args.saltpepper:
-                target_noise = random.random() * args.noise
-                new_img, new_ann = augmentate_saltnpeppernoise(new_img, new_ann, target_noise)
-
-            # Drawing bounding boxes and saving
-            if args.draw_bbox:
-                new_img = draw_annotations(new_img, new_ann, COLOR, THICKNESS)
-            save_to_disk(new_img, new_ann, fname + f"_augmented_{aug_iter}", args.folder_images, args.folder_anns)
-
-        curr_image_count += augs_for_this
+    if args.verbose and args.decode_cache:
+        lookups = results.cache_hits + results.cache_misses
+        print(f"[Info] Decode cache: {results.cache_hits} hits, {results.cache_misses} misses "
+              f"({results.cache_hits / lookups if lookups else 0:.1%} hit rate).")
+
+    if shard_writer is not None and args.verbose:
+        print(f"[Success] Wrote {len(shard_writer.paths)} shards to {args.output_shards}.")
+
+    if args.profile:
+        profiler.save(args.profile)
+        print(profiler.summary())
+        print(f"[Success] Saved the profile to {args.profile}")
 
+    if args.verbose and args.pipeline:
+        for stats in stage_stats:
+            print(f"[Info] {stats.summary()}")
     if args.verbose:
+        if args.target_size:
+            print(f"[Info] {downscale_summary(pairs, args.target_size)}")
+        print(f"[Info] Augmented {results.completed} images in {elapsed:.1f} s "
+              f"({results.completed / elapsed if elapsed else 0:.1f} images/s), wrote "
+              f"{results.bytes_written / (1 << 20):.1f} MB "
+              f"({results.bytes_written / max(1, results.completed) / 1024:.1f} KB per image).")
         print(f"[Success] Finished augmentation, {initial_image_count} images were supplied, {curr_image_count} "
               f"images were achieved through augmentation.")
+    return results
+
+
+def main():
+    run(parse_args())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Only the standard library is imported here, so a job starts without loading OpenCV, NumPy or tqdm
+
+
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), "image_augmentator.sock") if hasattr(socket, "AF_UNIX") \
+    else "127.0.0.1:8765"
+
+
+def parse_address(address):
+    """
+    :param address: Path of a Unix socket, or host:port of a TCP socket
+    :return: (socket family, address) for socket.socket and connect or bind
+    """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and os.sep not in host:
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+def send_message(stream, message):
+    # Messages are JSON objects, one per line
+    stream.write(json.dumps(message).encode() + b"\n")
+    stream.flush()
+
+
+def read_messages(stream):
+    for line in stream:
+        yield json.loads(line)
+
+
+def request(message, address=DEFAULT_ADDRESS, on_message=None):
+    family, target = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(target)
+        with sock.makefile("rwb") as stream:
+            send_message(stream, message)
+            for reply in read_messages(stream):
+                if reply["type"] == "done":
+                    return reply
+                if on_message is not None:
+                    on_message(reply)
+    raise ConnectionError("The daemon closed the connection before the job finished")
+
+
+def submit(argv, address=DEFAULT_ADDRESS, cwd=None, on_message=None):
+    """
+    Runs augment.py with the given arguments on a running augment_daemon.py
+    :param argv: augment.py command line arguments
+    :param address: Address the daemon listens on
+    :param cwd: Folder the relative paths of the arguments are relative to, the current folder if omitted
+    :param on_message: Called with every output and progress message of the job
+    :return: Final message of the job, with its exit status, duration, number of images and bytes written
+    """
+    return request({"argv": list(argv), "cwd": os.path.abspath(cwd or os.getcwd())}, address, on_message)
+
+
+def stop(address=DEFAULT_ADDRESS):
+    # The daemon finishes the running job first
+    return request({"stop": True}, address)
+
+
+class ConsolePrinter:
+    # Prints the output of a job, progress is redrawn in place on stderr until other output follows
+    def __init__(self):
+        self.progress_shown = False
+
+    def __call__(self, message):
+        if message["type"] == "output":
+            self.end_progress()
+            sys.stdout.write(message["text"])
+            sys.stdout.flush()
+        elif message["type"] == "progress":
+            sys.stderr.write(f"\r{message['desc']}: {message['done']}/{message['total']}")
+            sys.stderr.flush()
+            self.progress_shown = True
+
+    def end_progress(self):
+        if self.progress_shown:
+            sys.stderr.write("\n")
+            self.progress_shown = False
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False, description="Runs augment.py on a running augment_daemon.py, "
+                                                                 "takes the same arguments as augment.py.")
+    parser.add_argument("--daemon-address", type=str, required=False, default=DEFAULT_ADDRESS,
+                        help=f"Unix socket path or host:port of the daemon. Defaults to {DEFAULT_ADDRESS}")
+    parser.add_argument("--stop-daemon", action="store_true",
+                        help="Use this flag to stop the daemon once its running jobs are finished.")
+    args, argv = parser.parse_known_args()
+
+    printer = ConsolePrinter()
+    try:
+        if args.stop_daemon:
+            done = stop(args.daemon_address)
+        else:
+            done = submit(argv, args.daemon_address, on_message=printer)
+    except (ConnectionError, FileNotFoundError) as e:
+        print(f"[Error] Can't reach the daemon at {args.daemon_address}, start it with augment_daemon.py ({e}).")
+        sys.exit(1)
+    printer.end_progress()
+    sys.exit(done["status"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import argparse
+import ipaddress
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+from contextlib import redirect_stderr, redirect_stdout
+from augment import parse_args, run, init_worker
+from augment_client import DEFAULT_ADDRESS, parse_address, send_message
+
+
+# Arguments holding paths, made absolute because the warm workers don't run in the folder of the client
+PATH_OPTIONS = ("folder_images", "folder_anns", "manifest", "index_cache", "decode_cache", "profile", "output_shards",
+                "policy", "plan", "compile_plan", "tile_memmap")
+# Progress of a job is sent at most this often, and once it is complete
+PROGRESS_INTERVAL = 0.1
+
+
+class JobChannel:
+    """
+    Connection to the client of a job. It is a writable text stream, so the output augment.py prints reaches
+    the client, and hands out progress bars reporting to the client instead of drawing on the terminal.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            send_message(self.stream, message)
+
+    def write(self, text):
+        if text:
+            self.send({"type": "output", "text": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def progress_bar(self, desc="", total=0):
+        return JobProgress(self, desc, total)
+
+
+class JobProgress:
+    # Stands in for tqdm in augment.run, pipeline threads may update it concurrently
+    def __init__(self, channel, desc, total):
+        self.channel = channel
+        self.desc = desc
+        self.total = total
+        self.done = 0
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.report()
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def update(self, n=1):
+        with self.lock:
+            self.done += n
+            now = time.perf_counter()
+            if self.done < self.total and now - self.last < PROGRESS_INTERVAL:
+                return
+            self.last = now
+        self.report()
+
+    def report(self):
+        self.channel.send({"type": "progress", "desc": self.desc, "done": self.done, "total": self.total})
+
+
+def absolute_paths(args):
+    for option in PATH_OPTIONS:
+        value = getattr(args, option)
+        # Empty values select defaults or disable the option, they are kept as they are
+        if value:
+            setattr(args, option, os.path.abspath(value))
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one connection: reads a job of augment.py arguments and the folder of the client, runs it on
+    the warm worker pool and streams its output and progress back. Jobs run one at a time.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        channel = JobChannel(self.wfile)
+        if request.get("stop"):
+            with self.server.job_lock:
+                threading.Thread(target=self.server.shutdown).start()
+            channel.send({"type": "done", "status": 0})
+            return
+
+        status, results = 0, None
+        start = time.perf_counter()
+        with self.server.job_lock, redirect_stdout(channel), redirect_stderr(channel):
+            try:
+                os.chdir(request["cwd"])
+                args = parse_args(request["argv"])
+                absolute_paths(args)
+                args.job = uuid.uuid4().hex
+                results = run(args, self.server.pool, channel.progress_bar)
+            except SystemExit as e:
+                # Invalid arguments and --help end the job like they end augment.py
+                status = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        channel.send({"type": "done", "status": status, "seconds": time.perf_counter() - start,
+                      "completed": results.completed if results is not None else 0,
+                      "bytes_written": results.bytes_written if results is not None else 0})
+
+
+def is_loopback(host):
+    """
+    :param host: Host name or IPv4 address
+    :return: True if every address the host resolves to is a loopback address
+    """
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None, socket.AF_INET)}
+    except socket.gaierror:
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(a).is_loopback for a in addresses)
+
+
+def check_address(address, allow_remote=False):
+    # Jobs read and write any path the client names, with the privileges of the daemon, so they must stay local
+    family, target = parse_address(address)
+    if family != socket.AF_UNIX and not allow_remote and not is_loopback(target[0]):
+        raise ValueError(f"{target[0]} is not a loopback address, pass --allow-remote to accept jobs from "
+                         f"other machines")
+
+
+def make_server(address, pool, allow_remote=False):
+    """
+    :param address: Unix socket path or host:port to listen on
+    :param pool: Warm worker pool the jobs run on
+    :param allow_remote: Use this flag to listen on an address other machines can reach
+    :return: Server, call serve_forever to run it
+    """
+    check_address(address, allow_remote)
+    family, target = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(target):
+            # A socket left behind by a daemon that didn't shut down cleanly is replaced, a live one is not
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(target)
+                    raise OSError(f"A daemon is already listening on {target}")
+                except (ConnectionRefusedError, FileNotFoundError):
+                    os.remove(target)
+        server = socketserver.ThreadingUnixStreamServer(target, JobHandler)
+    else:
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer(target, JobHandler)
+    server.daemon_threads = True
+    server.pool = pool
+    server.job_lock = threading.Lock()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keeps augment.py workers and their caches warm between runs, "
+                                                 "and runs the jobs submitted by augment_client.py.")
+    parser.add_argument("--address", type=str, required=False, default=DEFAULT_ADDRESS,
+                        help=f"Unix socket path or host:port to listen on, the host must be a loopback address "
+                             f"unless --allow-remote is given. Defaults to {DEFAULT_ADDRESS}")
+    parser.add_argument("--allow-remote", action="store_true", default=False,
+                        help="Use this flag to listen on a host:port other machines can reach. Jobs are not "
+                             "authenticated, anyone who reaches it can read and write files as the daemon's user.")
+    parser.add_argument("--workers", type=int, required=False, default=os.cpu_count() or 1,
+                        help="Number of worker processes, they run the jobs in place of --workers. "
+                             "Defaults to the number of CPUs")
+    parser.add_argument("--cv-threads", type=int, required=False, default=None,
+                        help="OpenCV threads per worker. Defaults to the number of CPUs divided by --workers")
+    args = parser.parse_args()
+    try:
+        check_address(args.address, args.allow_remote)
+    except ValueError as e:
+        parser.error(str(e))
+
+    cv_threads = args.cv_threads or max(1, (os.cpu_count() or 1) // args.workers)
+    # Workers are started before the server, so they share the imports but not the listening socket
+    with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(cv_threads,)) as pool:
+        server = make_server(args.address, pool, args.allow_remote)
+        print(f"[Success] Listening on {args.address} with {args.workers} workers.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if server.address_family == socket.AF_UNIX:
+                os.remove(server.server_address)
+    print("[Info] Stopped the daemon.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from augment import build_parser, augment_unit, process_unit, save_to_disk
+from buffers import BufferPool
+from utils import *
+
+
+# Representative parameters for each augmentation, within the ranges sampled by augment.py
+OPERATIONS = {
+    "rotation": lambda img, ann, rng: augmentate_rotation(img, ann, 30)[:2],
+    "perspective": lambda img, ann, rng: augmentate_perspective(img, ann, 40, 60, 30, 50),
+    "flip": lambda img, ann, rng: augmentate_flip(img, ann, "h"),
+    "saltnpeppernoise": lambda img, ann, rng: augmentate_saltnpeppernoise(img, ann, 0.001, rng),
+    "bilateral": lambda img, ann, rng: augmentate_bilateral(img, ann, 11, 50, 44),
+    "gaussianblur": lambda img, ann, rng: augmentate_gaussianblur(img, ann, 5, 5, 12.5),
+    "shift": lambda img, ann, rng: augmentate_shift(img, ann, 7.5, -4.2),
+    "shift_whole_pixels": lambda img, ann, rng: augmentate_shift(img, ann, 7, -4),
+    "rotation_right_angle": lambda img, ann, rng: augmentate_rotation(img, ann, 90)[:2],
+    "hsv": lambda img, ann, rng: augmentate_hsv(img, ann, 60, 2.45),
+    "contrast": lambda img, ann, rng: augmentate_contrast(img, ann, 0.75),
+    "sharpness": lambda img, ann, rng: augmentate_sharpness(img, ann, 11, 50),
+    "geometric": lambda img, ann, rng: augmentate_geometric(img, ann, 30, (40, 60, 30, 50), "h", (7.5, -4.2)),
+}
+
+# Approximations of --filter-quality fast and the exact ops they replace, at the small and large end of the
+# sampled ranges. They are compared by speedup and by the PSNR and SSIM of their outputs against the exact ones.
+APPROXIMATIONS = {
+    "bilateral_fast": (lambda img, ann, rng: augmentate_bilateral(img, ann, 11, 50, 44),
+                       lambda img, ann, rng: augmentate_bilateral_fast(img, ann, 11, 50, 44)),
+    "bilateral_large_fast": (lambda img, ann, rng: augmentate_bilateral(img, ann, 22, 90, 80),
+                             lambda img, ann, rng: augmentate_bilateral_fast(img, ann, 22, 90, 80)),
+    "gaussianblur_large_fast": (lambda img, ann, rng: augmentate_gaussianblur(img, ann, 23, 23, 12.5),
+                                lambda img, ann, rng: augmentate_gaussianblur_fast(img, ann, 23, 23, 12.5)),
+    "sharpness_fast": (lambda img, ann, rng: augmentate_sharpness(img, ann, 11, 50),
+                       lambda img, ann, rng: augmentate_sharpness_fast(img, ann, 11, 50)),
+}
+
+ALL_AUGMENTATIONS = ["--do-rotation", "--perspective", "--flip", "--saltpepper", "--bilateral", "--gaussian",
+                     "--hsv", "--contrast", "--sharpness", "--do-shift"]
+
+
+def synthetic_sample(width, height, boxes, seed=0):
+    """
+    Creates a textured image with random YOLO annotations
+    :param width: Width of the image
+    :param height: Height of the image
+    :param boxes: Number of bounding boxes
+    :param seed: Random seed
+    :return: BGR image and (boxes, 5) annotations
+    """
+    rng = np.random.default_rng(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    noise = rng.integers(0, 64, (height, width, 3), dtype=np.uint8)
+    image = cv2.add(np.broadcast_to(gradient, (height, width, 3)).astype(np.uint8), noise)
+
+    sizes = rng.uniform(0.02, 0.2, (boxes, 2))
+    centers = rng.uniform(sizes / 2, 1 - sizes / 2)
+    classes = rng.integers(0, 3, (boxes, 1))
+    return image, as_annotations(np.hstack([classes, centers, sizes]))
+
+
+def pipeline_operation(fuse_geometry, pool=None, filter_quality="exact"):
+    flags = ALL_AUGMENTATIONS + ["--seed", "0", "--filter-quality", filter_quality]
+    flags += ["--fuse-geometry"] if fuse_geometry else []
+    args = build_parser().parse_args(flags)
+    counter = iter(range(sys.maxsize))
+    if pool is None:
+        return lambda img, ann, rng: augment_unit(img, ann, 0, next(counter), args)
+
+    def operation(img, ann, rng):
+        # The result goes back to the pool like augment.py does once it is written
+        new_img, new_ann = augment_unit(img, ann, 0, next(counter), args, pool=pool)
+        pool.give(new_img)
+        return new_img, new_ann
+    return operation
+
+
+def end_to_end_operation():
+    # Runs augment.py's work unit on a source file: decode, augment, encode and write the outputs
+    folder = tempfile.TemporaryDirectory(prefix="benchmark_")
+    args = build_parser().parse_args(ALL_AUGMENTATIONS + ["--seed", "0", "--folder-images", folder.name,
+                                                          "--folder-anns", folder.name, "--manifest", ""])
+    counter = iter(range(sys.maxsize))
+    sources = {}
+
+    def operation(img, ann, rng):
+        key = (img.shape, len(ann))
+        if key not in sources:
+            # The source is written once per case, only the reads and writes of augment.py are timed
+            img_path = os.path.join(folder.name, f"source_{len(sources)}.jpg")
+            ann_path = img_path[:-len(".jpg")] + ".txt"
+            save_to_disk(img, ann, os.path.basename(img_path)[:-len(".jpg")], folder.name, folder.name)
+            sources[key] = (img_path, ann_path)
+        aug_iter = next(counter)
+        # A new job token drops the decoded source kept per process, so every call decodes it again
+        args.job = aug_iter
+        process_unit((0, *sources[key], aug_iter), args)
+        return img, ann
+    return operation
+
+
+PIPELINES = {
+    "pipeline": lambda: pipeline_operation(False),
+    "pipeline_fused": lambda: pipeline_operation(True),
+    "pipeline_pooled": lambda: pipeline_operation(False, BufferPool()),
+    "pipeline_fast": lambda: pipeline_operation(False, filter_quality="fast"),
+    "pipeline_end_to_end": end_to_end_operation,
+}
+
+
+def peak_rss_mb():
+    """
+    :return: Peak resident memory of the process in megabytes, None if the platform doesn't report it
+    """
+    try:
+        import resource
+    except ImportError:
+        # Windows has no resource module, psutil reports the peak working set there
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / (1 << 20)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1 << 20) if platform.system() == "Darwin" else peak / (1 << 10)
+
+
+def measure(operation, image, annotations, repeats, warmup):
+    rng = np.random.default_rng(0)
+    for _ in range(warmup):
+        operation(image.copy(), annotations, rng)
+    latencies = []
+    for _ in range(repeats):
+        img = image.copy()
+        start = time.perf_counter()
+        operation(img, annotations, rng)
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def allocation_peak_mb(operation, image, annotations):
+    # Peak of the memory allocated during one call, NumPy and OpenCV outputs are both traced
+    img = image.copy()
+    rng = np.random.default_rng(0)
+    tracemalloc.start()
+    try:
+        operation(img, annotations, rng)
+        return tracemalloc.get_traced_memory()[1] / (1 << 20)
+    finally:
+        tracemalloc.stop()
+
+
+def ssim(a, b):
+    # Mean structural similarity over all channels, with the usual 11x11 Gaussian window of sigma 1.5
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    a, b = a.astype(np.float64), b.astype(np.float64)
+
+    def window(x):
+        return cv2.GaussianBlur(x, (11, 11), 1.5)
+
+    mu_a, mu_b = window(a), window(b)
+    var_a, var_b = window(a * a) - mu_a * mu_a, window(b * b) - mu_b * mu_b
+    covariance = window(a * b) - mu_a * mu_b
+    similarity = ((2 * mu_a * mu_b + c1) * (2 * covariance + c2)) / ((mu_a * mu_a + mu_b * mu_b + c1) *
+                                                                    (var_a + var_b + c2))
+    return float(similarity.mean())
+
+
+def approximation_quality(exact, fast, image, annotations, repeats, warmup):
+    """
+    Compares an approximate op against the exact one
+    :return: Dictionary of the p50 latency of the exact op, the speedup of the approximation, and the PSNR and
+    SSIM of its output against the exact output
+    """
+    rng = np.random.default_rng(0)
+    reference, _ = exact(image.copy(), annotations, rng)
+    approximate, _ = fast(image.copy(), annotations, rng)
+    exact_p50 = float(np.percentile(measure(exact, image, annotations, repeats, warmup), 50))
+    fast_p50 = float(np.percentile(measure(fast, image, annotations, repeats, warmup), 50))
+    return {"exact_p50_ms": exact_p50 * 1e3, "speedup": exact_p50 / fast_p50,
+            "psnr_db": float(cv2.PSNR(reference, approximate)), "ssim": ssim(reference, approximate)}
+
+
+def summarize(latencies, width, height, boxes, allocated_mb=0.0):
+    mean = float(latencies.mean())
+    return {
+        "mean_ms": mean * 1e3,
+        "p50_ms": float(np.percentile(latencies, 50)) * 1e3,
+        "p90_ms": float(np.percentile(latencies, 90)) * 1e3,
+        "p99_ms": float(np.percentile(latencies, 99)) * 1e3,
+        "megapixels_per_s": width * height / 1e6 / mean,
+        "boxes_per_s": boxes / mean,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_alloc_mb": allocated_mb,
+    }
+
+
+def run_benchmark(resolutions, box_counts, operations, repeats, warmup, verbose=True):
+    results = {}
+    for width, height in resolutions:
+        for boxes in box_counts:
+            image, annotations = synthetic_sample(width, height, boxes)
+            for name in operations:
+                if name in PIPELINES:
+                    operation = PIPELINES[name]()
+                elif name in APPROXIMATIONS:
+                    operation = APPROXIMATIONS[name][1]
+                else:
+                    operation = OPERATIONS[name]
+                latencies = measure(operation, image, annotations, repeats, warmup)
+                key = f"{name}@{width}x{height}/{boxes}"
+                results[key] = summarize(latencies, width, height, boxes,
+                                         allocation_peak_mb(operation, image, annotations))
+                if name in APPROXIMATIONS:
+                    results[key].update(approximation_quality(*APPROXIMATIONS[name], image, annotations, repeats,
+                                                              warmup))
+                if verbose:
+                    r = results[key]
+                    rss = f"{r['peak_rss_mb']:.0f}MB" if r["peak_rss_mb"] is not None else "n/a"
+                    print(f"{key:<40} p50={r['p50_ms']:9.2f}ms p99={r['p99_ms']:9.2f}ms "
+                          f"{r['megapixels_per_s']:9.2f}MP/s {r['boxes_per_s']:12.0f}boxes/s "
+                          f"rss={rss} alloc={r['peak_alloc_mb']:.1f}MB")
+                    if name in APPROXIMATIONS:
+                        print(f"{'':<40} exact p50={r['exact_p50_ms']:9.2f}ms speedup={r['speedup']:.1f}x "
+                              f"psnr={r['psnr_db']:.1f}dB ssim={r['ssim']:.4f}")
+    return results
+
+
+def compare(results, baseline, threshold, metric="p50_ms"):
+    """
+    Compares results against a stored baseline
+    :param results: Results of the current run
+    :param baseline: Results of the baseline run
+    :param threshold: Allowed relative slowdown, 0.1 allows 10% slower
+    :param metric: Latency metric to compare
+    :return: List of (key, baseline value, current value, relative change) for every regression
+    """
+    regressions = []
+    for key, current in results.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key][metric], current[metric]
+        change = after / before - 1 if before > 0 else 0.0
+        if change > threshold:
+            regressions.append((key, before, after, change))
+    return regressions
+
+
+def parse_resolution(value):
+    try:
+        width, height = map(int, value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Resolution '{value}' is not in WIDTHxHEIGHT format")
+    return width, height
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the throughput of the augmentations on synthetic data.")
+    parser.add_argument("--resolutions", type=parse_resolution, nargs="+", default=[(640, 480), (1920, 1080),
+                                                                                     (3840, 2160)],
+                        help="Image resolutions as WIDTHxHEIGHT. Defaults to 640x480 1920x1080 3840x2160")
+    parser.add_argument("--boxes", type=int, nargs="+", default=[10, 300],
+                        help="Bounding box counts per image. Defaults to 10 300")
+    parser.add_argument("--ops", type=str, nargs="+", default=list(OPERATIONS) + list(PIPELINES),
+                        choices=list(OPERATIONS) + list(PIPELINES) + list(APPROXIMATIONS),
+                        help="Operations to measure, the approximate filters are also compared against the exact "
+                             "ones. Defaults to every augmentation and the full pipeline")
+    parser.add_argument("--repeats", type=int, required=False, default=10,
+                        help="Timed runs per case. Defaults to 10")
+    parser.add_argument("--warmup", type=int, required=False, default=2,
+                        help="Untimed runs per case before measuring. Defaults to 2")
+    parser.add_argument("--output", type=str, required=False, default=None,
+                        help="JSON file to save the results to.")
+    parser.add_argument("--baseline", type=str, required=False, default=None,
+                        help="JSON file of a previous run to compare against.")
+    parser.add_argument("--threshold", type=float, required=False, default=0.1,
+                        help="Relative p50 slowdown reported as a regression. Defaults to 0.1")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.resolutions, args.boxes, args.ops, args.repeats, args.warmup)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"python": platform.python_version(), "opencv": cv2.__version__,
+                                "numpy": np.__version__, "machine": platform.machine(),
+                                "repeats": args.repeats},
+                       "results": results}, f, indent=2)
+        print(f"[Success] Saved results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for key, before, after, change in regressions:
+            print(f"[Warning] Regression in {key}: p50 {before:.2f}ms -> {after:.2f}ms ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print(f"[Success] No regressions beyond {args.threshold:.0%} against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class BufferPool:
+    """
+    Keeps released image buffers per shape and dtype, so a chain of augmentations reuses the same few
+    full-size buffers instead of allocating a new output for every op. Buffers of the least recently
+    used shapes are dropped once the pool holds more than max_bytes.
+    """
+
+    def __init__(self, max_bytes=512 << 20):
+        """
+        :param max_bytes: Maximum total size of the idle buffers
+        """
+        self.max_bytes = max_bytes
+        self.free = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def take(self, shape, dtype=np.uint8):
+        """
+        :param shape: Shape of the buffer
+        :param dtype: Data type of the buffer
+        :return: A buffer of that shape with undefined contents, the caller owns it until it is given back
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            buffers = self.free.get(key)
+            if buffers:
+                self.free.move_to_end(key)
+                buffer = buffers.pop()
+                self.total -= buffer.nbytes
+                return buffer
+        return np.empty(shape, dtype)
+
+    def give(self, buffer):
+        """
+        Returns a buffer to the pool, it must not be used by the caller afterwards
+        :param buffer: Buffer from take, views and read-only arrays are ignored
+        """
+        if not isinstance(buffer, np.ndarray) or buffer.base is not None or not buffer.flags.writeable:
+            return
+        key = (buffer.shape, buffer.dtype.str)
+        with self.lock:
+            self.free.setdefault(key, []).append(buffer)
+            self.free.move_to_end(key)
+            self.total += buffer.nbytes
+            while self.total > self.max_bytes and self.free:
+                _, dropped = self.free.popitem(last=False)
+                self.total -= sum(b.nbytes for b in dropped)
+
+
+class NullPool:
+    # Allocates a new buffer for every request and never keeps one, for results handed out to the caller
+    def take(self, shape, dtype=np.uint8):
+        return np.empty(shape, dtype)
+
+    def give(self, buffer):
+        pass
+
+
+NULL_POOL = NullPool()
+
+
+class MemmapPool:
+    """
+    Hands out buffers backed by temporary files, so the full-size intermediates of very large images
+    can be paged out instead of counting against the memory of a worker. Files are removed once unmapped.
+    """
+
+    def __init__(self, folder=None):
+        """
+        :param folder: Folder to create the files in, the system temporary folder if omitted
+        """
+        self.folder = folder
+
+    def take(self, shape, dtype=np.uint8):
+        with tempfile.TemporaryFile(dir=self.folder) as f:
+            return np.memmap(f, dtype=dtype, mode="w+", shape=tuple(shape))
+
+    def give(self, buffer):
+        pass
+
+
+class PingPong:
+    """
+    Threads one image through a chain of ops. Every op reads the current image and writes into a buffer
+    from the pool, after which the previous image goes back to the pool, so the chain alternates between
+    two buffers. The source image is only read, pointwise ops work in place once the chain owns its image.
+    """
+
+    def __init__(self, source, pool=NULL_POOL, owned=False):
+        """
+        :param source: Image at the start of the chain
+        :param pool: Pool to take buffers from and give them back to
+        :param owned: Use this flag if the chain may write into source and give it back to the pool
+        """
+        self.pool = pool
+        self.current = source
+        self.owned = owned
+
+    def dst(self, shape=None):
+        """
+        :param shape: Shape of the next output, the shape of the current image if omitted
+        :return: A buffer for an op that can't work in place
+        """
+        return self.pool.take(self.current.shape if shape is None else shape, self.current.dtype)
+
+    def inplace(self):
+        """
+        :return: A buffer for a pointwise op, the current image itself once the chain owns it
+        """
+        return self.current if self.owned else self.dst()
+
+    def release(self, buffer):
+        self.pool.give(buffer)
+
+    def advance(self, result):
+        """
+        Makes the output of an op the current image
+        :param result: Output of the op
+        :return: The output of the op
+        """
+        if result is not self.current:
+            if self.owned:
+                self.pool.give(self.current)
+            self.current = result
+            self.owned = True
+        return result
+
+    def finish(self):
+        """
+        :return: The final image, copied if the chain never wrote one, so the caller always owns it
+        """
+        if not self.owned:
+            copy = self.dst()
+            np.copyto(copy, self.current)
+            self.advance(copy)
+        return self.current
@@ -1,12 +1,40 @@
+import argparse
 import os
-import glob
 from tqdm import tqdm
+from manifest import Manifest
+from shards import shard_files
+from dataset_index import scan_folder, augmented_base
 
 
-files_list = list(glob.glob("./*/*_augmented_*.jpg")) + list(glob.glob("./*/*_augmented_*.txt"))
+parser = argparse.ArgumentParser(description="Deletes the outputs of augment.py.")
+parser.add_argument("shard_folders", type=str, nargs="*",
+	help="Shard folders written with augment.py --output-shards.")
+parser.add_argument("--manifest", type=str, required=False, default="./augment_manifest.jsonl",
+	help="Run manifest listing the outputs to delete, as passed to augment.py. Defaults to ./augment_manifest.jsonl")
+args = parser.parse_args()
+manifest_path = args.manifest
+
+# Runs with a manifest delete exactly what they produced, older runs fall back to the naming pattern
+if os.path.exists(manifest_path):
+	files_list = sorted(Manifest(manifest_path).outputs())
+else:
+	files_list = []
+	for folder in sorted(e.path for e in os.scandir(".") if e.is_dir()):
+		catalog = scan_folder(folder, count=False)
+		for i, name in enumerate(catalog.names):
+			stem, ext = os.path.splitext(name)
+			if ext in (".jpg", ".png", ".webp", ".txt") and augmented_base(stem) is not None:
+				files_list.append(catalog.path(i))
+for shard_folder in args.shard_folders:
+	files_list += shard_files(shard_folder)
 for i in tqdm(range(len(files_list)), desc="Deleting augmented files..."):
 	f = files_list[i]
 	try:
 		os.remove(f)
+	except FileNotFoundError:
+		pass
 	except OSError:
 		print(f"[Error] Can't delete {f}")
+
+if os.path.exists(manifest_path):
+	os.remove(manifest_path)
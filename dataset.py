@@ -0,0 +1,194 @@
+import multiprocessing
+import queue
+import numpy as np
+import cv2
+from multiprocessing import resource_tracker, shared_memory
+from augment import build_parser, build_units, load_source, augment_unit, source_key, unit_seed
+from dataset_index import DatasetIndex
+
+
+class AugmentedDataset:
+    """
+    Augments samples on the fly instead of writing them to disk. Samples are the same (image, annotations)
+    pairs augment.py would write for the same flags and seed, and a new epoch draws new variants.
+
+    Example:
+        dataset = AugmentedDataset("./images", "./annotations", ["--hsv", "--flip", "--augs", "4"], seed=0)
+        for images, annotations in dataset.batches(16, workers=4):
+            ...
+    """
+
+    def __init__(self, folder_images="./images", folder_anns="./annotations", flags=(), seed=0, cache_dir=None):
+        """
+        :param folder_images: The folder where image data are located
+        :param folder_anns: The folder where annotations are located
+        :param flags: augment.py command line flags selecting the augmentations, for example ["--hsv", "--flip"]
+        :param seed: Global random seed
+        :param cache_dir: Folder to cache the folder listings in for a fast start, nothing is written if omitted
+        """
+        self.args = build_parser().parse_args(list(flags) + ["--folder-images", folder_images,
+                                                             "--folder-anns", folder_anns, "--seed", str(seed),
+                                                             "--index-cache", cache_dir or ""])
+        self.base_seed = seed
+        index = DatasetIndex(folder_images, folder_anns, cache_dir)
+        if index.missing:
+            raise ValueError(f"Found {len(index.missing)} images without an annotation, for example {index.missing[0]}")
+        self.pairs = index.pairs
+        self.epoch = 0
+        self.units = build_units(self.pairs, self.args)
+
+    def set_epoch(self, epoch):
+        """
+        Switches to the variants of another epoch, every epoch samples its own augmentation parameters
+        :param epoch: Epoch number, epoch 0 matches augment.py run with the same seed
+        """
+        self.epoch = epoch
+        self.args.seed = self.base_seed if epoch == 0 else unit_seed(self.base_seed, epoch)
+        self.units = build_units(self.pairs, self.args)
+
+    def __len__(self):
+        return len(self.units)
+
+    def __getitem__(self, i):
+        """
+        :param i: Index of the sample
+        :return: Augmented image and (N, 5) annotations
+        """
+        _, img_path, ann_path, aug_iter = self.units[i]
+        original_img, original_anns = load_source(img_path, ann_path, self.args)
+        return augment_unit(original_img, original_anns, source_key(img_path), aug_iter, self.args)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def order(self, shuffle=False):
+        if not shuffle:
+            return list(range(len(self)))
+        return np.random.default_rng(unit_seed(self.base_seed, self.epoch)).permutation(len(self)).tolist()
+
+    def batches(self, batch_size=1, workers=0, prefetch=2, shuffle=False, drop_last=False):
+        """
+        Yields batches of augmented samples, optionally prepared by background worker processes
+        :param batch_size: Number of samples per batch
+        :param workers: Number of worker processes, 0 augments in the calling process
+        :param prefetch: Number of batches each worker prepares ahead
+        :param shuffle: Use this flag to visit the samples in a random order, fixed per epoch
+        :param drop_last: Use this flag to drop the last batch if it is smaller than batch_size
+        :return: Generator of (list of images, list of annotations) batches, in a deterministic order
+        """
+        order = self.order(shuffle)
+        batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+        if drop_last and batches and len(batches[-1]) < batch_size:
+            batches.pop()
+
+        if workers <= 0:
+            for batch in batches:
+                samples = [self[i] for i in batch]
+                yield [s[0] for s in samples], [s[1] for s in samples]
+            return
+
+        yield from self._prefetched(batches, workers, prefetch)
+
+    def _prefetched(self, batches, workers, prefetch):
+        context = multiprocessing.get_context()
+        tasks = context.Queue()
+        results = context.Queue()
+        processes = [context.Process(target=_batch_worker, args=(self, tasks, results), daemon=True)
+                     for _ in range(workers)]
+        for p in processes:
+            p.start()
+
+        submitted = 0
+        ready = {}
+        try:
+            # Keep up to prefetch batches per worker in flight, and hand them out in order
+            for batch_id in range(len(batches)):
+                while submitted < len(batches) and submitted < batch_id + workers * prefetch:
+                    tasks.put((submitted, batches[submitted]))
+                    submitted += 1
+                while batch_id not in ready:
+                    done_id, payload = results.get()
+                    if isinstance(payload, BaseException):
+                        raise payload
+                    ready[done_id] = payload
+                yield _unpack_batch(*ready.pop(batch_id))
+        finally:
+            for _ in processes:
+                tasks.put(None)
+            for p in processes:
+                p.join(timeout=1)
+                if p.is_alive():
+                    p.terminate()
+            # Blocks that were prepared but never consumed would otherwise outlive the run
+            for payload in ready.values():
+                _release(payload[0])
+            while True:
+                try:
+                    _, payload = results.get_nowait()
+                except queue.Empty:
+                    break
+                if not isinstance(payload, BaseException):
+                    _release(payload[0])
+
+
+def _pack_batch(samples):
+    # Images are laid out back to back in one shared memory block, only their shapes travel through the queue
+    images = [np.ascontiguousarray(s[0]) for s in samples]
+    size = max(1, sum(img.nbytes for img in images))
+    block = shared_memory.SharedMemory(create=True, size=size)
+    layout = []
+    offset = 0
+    for img in images:
+        np.ndarray(img.shape, img.dtype, buffer=block.buf, offset=offset)[...] = img
+        layout.append((img.shape, img.dtype.str, offset))
+        offset += img.nbytes
+    name = block.name
+    block.close()
+    return name, layout, [s[1] for s in samples]
+
+
+def _unpack_batch(name, layout, annotations):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        # One copy out of the block, so the block can be released right away
+        images = [np.ndarray(shape, np.dtype(dtype), buffer=block.buf, offset=offset).copy()
+                  for shape, dtype, offset in layout]
+    finally:
+        block.close()
+        block.unlink()
+    return images, annotations
+
+
+def _release(name):
+    try:
+        block = shared_memory.SharedMemory(name=name)
+        block.close()
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _batch_worker(dataset, tasks, results):
+    cv2.setNumThreads(1)
+    # The consumer unlinks the blocks, the worker's resource tracker must not unlink them a second time
+    _untrack_shared_memory()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_id, batch = task
+        try:
+            results.put((batch_id, _pack_batch([dataset[i] for i in batch])))
+        except Exception as e:
+            results.put((batch_id, e))
+
+
+def _untrack_shared_memory():
+    register = resource_tracker.register
+
+    def register_except_shared_memory(name, rtype):
+        if rtype != "shared_memory":
+            register(name, rtype)
+
+    resource_tracker.register = register_except_shared_memory
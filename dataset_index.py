@@ -0,0 +1,202 @@
+import hashlib
+import os
+import time
+import numpy as np
+
+
+INDEX_CACHE = "./.dataset_index"
+ANNOTATION_EXTENSION = ".txt"
+# Folders modified this recently may still change within the same mtime tick, their catalogs are not trusted
+RACY_SECONDS = 2
+
+
+def split_stem(name):
+    """
+    :param name: File name
+    :return: File name without its extension
+    """
+    return os.path.splitext(name)[0]
+
+
+def augmented_base(stem):
+    """
+    Recognizes the names augment.py gives its outputs
+    :param stem: File name without its extension
+    :return: Stem of the source the output was made from, None if the name is not an augmented output
+    """
+    base, _, number = stem.rpartition("_augmented_")
+    return base if base and number.isdigit() else None
+
+
+def count_boxes(path):
+    with open(path, "rb") as f:
+        return len(f.read().split()) // 5
+
+
+class Catalog:
+    """
+    Listing of the files of one folder, as parallel lists of names, sizes, mtimes and box counts.
+    Box counts are only filled in for annotation files, other files hold -1.
+    """
+
+    def __init__(self, folder, names, sizes, mtimes, boxes, folder_mtime=0):
+        self.folder = folder
+        self.names = names
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.boxes = boxes
+        self.folder_mtime = folder_mtime
+
+    def __len__(self):
+        return len(self.names)
+
+    def path(self, i):
+        return os.path.join(self.folder, self.names[i])
+
+    def stems(self):
+        return [split_stem(name) for name in self.names]
+
+    def save(self, path):
+        # Names are kept as one NUL separated blob, so millions of entries load in a single read
+        blob = np.frombuffer("\0".join(self.names).encode(), dtype=np.uint8)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, names=blob, sizes=np.asarray(self.sizes, dtype=np.int64),
+                     mtimes=np.asarray(self.mtimes, dtype=np.int64), boxes=np.asarray(self.boxes, dtype=np.int32),
+                     folder_mtime=np.int64(self.folder_mtime))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, folder, path):
+        with np.load(path) as data:
+            blob = data["names"].tobytes().decode()
+            return cls(folder, blob.split("\0") if blob else [], data["sizes"].tolist(), data["mtimes"].tolist(),
+                       data["boxes"].tolist(), int(data["folder_mtime"]))
+
+
+def scan_folder(folder, previous=None, count=True):
+    """
+    Lists a folder in a single os.scandir pass, box counts of unchanged annotations are taken over from previous
+    :param folder: Folder to list
+    :param previous: Earlier catalog of the same folder, or None
+    :param count: Use this flag to count the bounding boxes of the annotations, otherwise they hold -1
+    :return: Catalog of the folder, sorted by name
+    """
+    folder_mtime = os.stat(folder).st_mtime_ns
+    if time.time_ns() - folder_mtime < RACY_SECONDS * 10 ** 9:
+        folder_mtime = 0
+    known = {}
+    if previous is not None:
+        known = {name: (size, mtime, boxes) for name, size, mtime, boxes
+                 in zip(previous.names, previous.sizes, previous.mtimes, previous.boxes)}
+
+    rows = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            boxes = -1
+            if count and entry.name.endswith(ANNOTATION_EXTENSION):
+                old = known.get(entry.name)
+                if old is not None and old[:2] == (stat.st_size, stat.st_mtime_ns):
+                    boxes = old[2]
+                else:
+                    boxes = count_boxes(entry.path)
+            rows.append((entry.name, stat.st_size, stat.st_mtime_ns, boxes))
+    rows.sort()
+    names, sizes, mtimes, boxes = (list(column) for column in zip(*rows)) if rows else ([], [], [], [])
+    return Catalog(folder, names, sizes, mtimes, boxes, folder_mtime)
+
+
+def catalog_path(folder, cache_dir=INDEX_CACHE):
+    key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{key}.npz")
+
+
+def load_catalog(folder, cache_dir=INDEX_CACHE, refresh=False):
+    """
+    Loads the catalog of a folder from the cache, it is scanned again only if files were added, removed or renamed
+    since. Files rewritten in place do not touch the folder, pass refresh=True to pick up their new sizes.
+    :param folder: Folder to list
+    :param cache_dir: Folder to keep the catalogs in, None disables the cache
+    :param refresh: Use this flag to scan the folder even if its cached catalog looks current
+    :return: Catalog of the folder
+    """
+    if not cache_dir:
+        return scan_folder(folder)
+    path = catalog_path(folder, cache_dir)
+    previous = None
+    try:
+        previous = Catalog.load(folder, path)
+    except (OSError, ValueError, KeyError):
+        pass
+    if previous is not None and not refresh and previous.folder_mtime == os.stat(folder).st_mtime_ns:
+        return previous
+    catalog = scan_folder(folder, previous)
+    os.makedirs(cache_dir, exist_ok=True)
+    catalog.save(path)
+    return catalog
+
+
+class DatasetIndex:
+    """
+    Joins the images of one folder to the annotations of another by file stem. Images without an annotation
+    and annotations without an image are reported instead of shifting every later pair.
+    """
+
+    def __init__(self, folder_images="./images", folder_anns="./annotations", cache_dir=INDEX_CACHE, exclude=(),
+                 refresh=False):
+        """
+        :param folder_images: The folder where image data are located
+        :param folder_anns: The folder where annotations are located
+        :param cache_dir: Folder to keep the folder catalogs in, None disables the cache
+        :param exclude: Absolute paths to leave out, such as the outputs of earlier runs
+        :param refresh: Use this flag to scan the folders even if their cached catalogs look current
+        """
+        self.images = load_catalog(folder_images, cache_dir, refresh)
+        self.annotations = self.images if os.path.samefile(folder_images, folder_anns) \
+            else load_catalog(folder_anns, cache_dir, refresh)
+        exclude = set(exclude)
+
+        def excluded(catalog, name):
+            return bool(exclude) and os.path.abspath(os.path.join(catalog.folder, name)) in exclude
+
+        anns = {}
+        for i, name in enumerate(self.annotations.names):
+            if name.endswith(ANNOTATION_EXTENSION) and not excluded(self.annotations, name):
+                anns[split_stem(name)] = i
+        images = {}
+        for i, name in enumerate(self.images.names):
+            if not name.endswith(ANNOTATION_EXTENSION) and not excluded(self.images, name):
+                images.setdefault(split_stem(name), i)
+        drop_partial_outputs(images)
+        drop_partial_outputs(anns)
+
+        self.pairs = []
+        self.boxes = []
+        self.missing = []
+        for stem, i in sorted(images.items(), key=lambda kv: self.images.names[kv[1]]):
+            j = anns.get(stem)
+            if j is None:
+                self.missing.append(self.images.path(i))
+            else:
+                self.pairs.append((self.images.path(i), self.annotations.path(j)))
+                self.boxes.append(self.annotations.boxes[j])
+        self.orphans = [self.annotations.path(j) for stem, j in sorted(anns.items()) if stem not in images]
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+    def total_boxes(self):
+        return sum(self.boxes)
+
+
+def drop_partial_outputs(by_stem):
+    # Outputs of sources an interrupted run never finished are not in the manifest, but they are named
+    # "<source>_augmented_<n>" after a source that is still in the folder
+    for stem in [stem for stem in by_stem if augmented_base(stem) in by_stem]:
+        del by_stem[stem]
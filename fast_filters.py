@@ -0,0 +1,125 @@
+import numpy as np
+import cv2
+from functools import lru_cache
+
+
+# The approximate bilateral filter runs on an image downscaled until its radius is at most this many pixels
+FAST_BILATERAL_RADIUS = 2
+# Smaller Gaussian kernels are cheap enough to apply exactly
+FAST_KERNEL_MIN = 9
+
+
+def bilateral_radius(dist, sspace):
+    # Radius OpenCV derives from the diameter, or from sigma_space when no diameter is given
+    return dist // 2 if dist > 0 else int(round(max(sspace, 1) * 1.5))
+
+
+@lru_cache(maxsize=256)
+def detail_gain_lut(scolor, channels=3):
+    """
+    :param scolor: Sigma of the color distance
+    :param channels: Number of channels of the image
+    :return: Share of the detail to keep for every mean absolute difference of the channels, which weighs their
+    L1 distance like the range weight of the bilateral filter
+    """
+    sigma = max(scolor, 1)
+    distance = np.arange(256, dtype=np.float32) * channels
+    lut = 1 - np.exp(-distance * distance / (2 * sigma * sigma))
+    lut.flags.writeable = False
+    return lut
+
+
+def fast_bilateral(image, dist, scolor, sspace, dst=None):
+    """
+    Approximates cv2.bilateralFilter by filtering a downscaled copy, whose cost doesn't grow with the diameter.
+    The detail lost by downscaling is added back where it differs from its surroundings by more than the color
+    sigma, so edges stay sharp while flat regions get the smoothing of the large filter.
+    :param image: Image to filter
+    :param dist: Diameter of the filter, 0 to derive it from sspace
+    :param scolor: Sigma of the color distance
+    :param sspace: Sigma of the spatial distance
+    :param dst: Preallocated output, must be a different buffer than image
+    :return: Filtered image
+    """
+    factor = -(-bilateral_radius(dist, sspace) // FAST_BILATERAL_RADIUS)
+    if factor < 2:
+        return cv2.bilateralFilter(image, dist, scolor, sspace, dst=dst)
+    height, width = image.shape[:2]
+    channels = image.shape[2] if image.ndim == 3 else 1
+    small = cv2.resize(image, (max(1, round(width / factor)), max(1, round(height / factor))),
+                       interpolation=cv2.INTER_AREA)
+    filtered = cv2.bilateralFilter(small, max(1, round(dist / factor)) if dist > 0 else 0, scolor, sspace / factor)
+
+    base = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+    distance = cv2.absdiff(image, base)
+    if channels > 1:
+        distance = cv2.transform(distance, np.full((1, channels), 1 / channels))
+    gain = cv2.LUT(distance, detail_gain_lut(scolor, channels))
+    if channels > 1:
+        gain = cv2.merge([gain] * channels)
+    detail = cv2.multiply(cv2.subtract(image, base, dtype=cv2.CV_32F), gain)
+    upscaled = cv2.resize(filtered, (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.add(detail, upscaled, dst=dst, dtype=cv2.CV_8U)
+
+
+def _odd(width):
+    return max(1, int(round((width - 1) / 2)) * 2 + 1)
+
+
+@lru_cache(maxsize=512)
+def box_cascade(ksize, sigma):
+    """
+    Picks one or two box filters whose combined kernel is closest to a truncated Gaussian kernel
+    :param ksize: Size of the Gaussian kernel
+    :param sigma: Sigma of the Gaussian kernel, 0 to derive it from ksize like OpenCV
+    :return: Tuple of box widths to apply one after the other
+    """
+    if ksize < FAST_KERNEL_MIN:
+        return ()
+    gaussian = cv2.getGaussianKernel(ksize, sigma, ktype=cv2.CV_64F).ravel()
+    offsets = np.arange(ksize) - ksize // 2
+    variance = float((gaussian * offsets * offsets).sum())
+    best = None
+    for passes in (1, 2):
+        width = _odd(np.sqrt(12 * variance / passes + 1))
+        kernel = np.ones(1)
+        for _ in range(passes):
+            kernel = np.convolve(kernel, np.full(width, 1 / width))
+        size = max(len(kernel), ksize)
+        error = np.abs(np.pad(kernel, (size - len(kernel)) // 2) - np.pad(gaussian, (size - ksize) // 2)).sum()
+        if best is None or error < best[0]:
+            best = (error, (width,) * passes)
+    return best[1]
+
+
+def box_cascade_radius(ksize, sigma):
+    """
+    :return: Number of neighbors on each side that fast_gaussian reads along an axis with this kernel
+    """
+    widths = box_cascade(ksize, sigma)
+    return sum(width // 2 for width in widths) if widths else ksize // 2
+
+
+def fast_gaussian(image, kw, kh, sigma, dst=None):
+    """
+    Approximates cv2.GaussianBlur by a cascade of box filters, which cost the same for any kernel size.
+    Kernels smaller than FAST_KERNEL_MIN are applied exactly.
+    :param image: Image to blur
+    :param kw: Width of the Gaussian kernel
+    :param kh: Height of the Gaussian kernel
+    :param sigma: Sigma of the Gaussian kernel in both directions
+    :param dst: Preallocated output, may be image itself
+    :return: Blurred image
+    """
+    widths_x, widths_y = box_cascade(kw, sigma), box_cascade(kh, sigma)
+    if not widths_x and not widths_y:
+        return cv2.GaussianBlur(image, (kw, kh), sigma, dst=dst)
+    # A small kernel along one axis is applied exactly first, the boxes then only run along the other
+    if not widths_x or not widths_y:
+        image = cv2.GaussianBlur(image, (1 if widths_x else kw, 1 if widths_y else kh), sigma)
+    passes = max(len(widths_x), len(widths_y))
+    widths_x += (1,) * (passes - len(widths_x))
+    widths_y += (1,) * (passes - len(widths_y))
+    for i, box in enumerate(zip(widths_x, widths_y)):
+        image = cv2.blur(image, box, dst=dst if i == passes - 1 else None)
+    return image
@@ -1,3 +1,7 @@
+import struct
+import numpy as np
+
+
 def yolotocv(x1, y1, x2, y2, h, w):
     """
     Converts YOLO format bounding box dimensions to OpenCV format
@@ -42,3 +46,128 @@ def cvtoyolo(x1, y1, x2, y2, h, w):
 
 def clamp_value(val, minclamp, maxclamp):
     return max(minclamp, min(maxclamp, val))
+
+
+def yolotocv_array(boxes, h, w):
+    """
+    Converts an array of YOLO format bounding boxes to OpenCV format corners
+    :param boxes: (N, 4) array of center x, center y, width and height of the bounding boxes
+    :param h: Height of the image
+    :param w: Width of the image
+    :return: (N, 4) float32 array of x1, y1, x2, y2 corners, truncated to whole pixels like yolotocv
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scale = np.array([w, h], dtype=np.float32)
+    centers = boxes[:, :2] * scale
+    half_sizes = boxes[:, 2:] * scale / 2
+    return np.trunc(np.hstack([centers - half_sizes, centers + half_sizes]))
+
+
+def cvtoyolo_array(corners, h, w):
+    """
+    Converts an array of OpenCV format corners to YOLO format bounding boxes
+    :param corners: (N, 4) array of x1, y1, x2, y2 corners of the bounding boxes
+    :param h: Height of the image
+    :param w: Width of the image
+    :return: (N, 4) float32 array of center x, center y, width and height of the bounding boxes
+    """
+    corners = np.asarray(corners, dtype=np.float32).reshape(-1, 4)
+    scale = np.array([w, h], dtype=np.float32)
+    centers = (corners[:, :2] + corners[:, 2:]) / 2 / scale
+    sizes = (corners[:, 2:] - corners[:, :2]) / scale
+    return np.hstack([centers, sizes])
+
+
+def clip_boxes(classes, corners, h, w, minobjsize=0.001):
+    """
+    Clips OpenCV format corners to the image and drops the boxes that became too small
+    :param classes: (N,) array of object classes
+    :param corners: (N, 4) array of x1, y1, x2, y2 corners of the bounding boxes
+    :param h: Height of the image
+    :param w: Width of the image
+    :param minobjsize: Minimum normalized width/height for a bounding box to be kept
+    :return: (M, 5) float32 array of YOLO format annotations
+    """
+    corners = np.clip(corners, 0, np.array([w, h, w, h], dtype=np.float32))
+    dims = cvtoyolo_array(corners, h, w)
+    keep = (dims[:, 2] > minobjsize) & (dims[:, 3] > minobjsize)
+    return np.hstack([np.asarray(classes, dtype=np.float32).reshape(-1, 1)[keep], dims[keep]])
+
+
+def as_annotations(annotations):
+    """
+    Brings annotations to the (N, 5) float32 array layout used throughout the augmentations
+    :param annotations: Array or list of [class, center x, center y, width, height] rows
+    :return: (N, 5) float32 array of annotations
+    """
+    return np.asarray(annotations, dtype=np.float32).reshape(-1, 5)
+
+
+def load_annotations(path):
+    """
+    Reads a YOLO annotation file in one pass
+    :param path: Path of the annotation file
+    :return: (N, 5) float32 array of annotations
+    """
+    with open(path, "r") as f:
+        return as_annotations(np.array(f.read().split(), dtype=np.float32))
+
+
+def format_annotations(annotations):
+    """
+    Formats annotations as the text of a YOLO annotation file
+    :param annotations: (N, 5) array of annotations
+    :return: Text with one "class cx cy w h" line per bounding box
+    """
+    annotations = as_annotations(annotations)
+    return ("%d %.6f %.6f %.6f %.6f\n" * len(annotations)) % tuple(annotations.ravel().tolist())
+
+
+def save_annotations(path, annotations):
+    """
+    Writes annotations to a YOLO annotation file in one write
+    :param path: Path of the annotation file
+    :param annotations: (N, 5) array of annotations
+    """
+    with open(path, "w") as f:
+        f.write(format_annotations(annotations))
+
+
+def image_size(path):
+    """
+    Reads the dimensions of a JPEG, PNG or WebP image from its header, without decoding the pixels
+    :param path: Path of the image
+    :return: Height and width of the image, None if the format is not recognized
+    """
+    with open(path, "rb") as f:
+        head = f.read(30)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            w, h = struct.unpack(">II", head[16:24])
+            return h, w
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            if head[12:16] == b"VP8 ":
+                w, h = struct.unpack("<HH", head[26:30])
+                return h & 0x3fff, w & 0x3fff
+            if head[12:16] == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return ((bits >> 14) & 0x3fff) + 1, (bits & 0x3fff) + 1
+            if head[12:16] == b"VP8X":
+                return int.from_bytes(head[27:30], "little") + 1, int.from_bytes(head[24:27], "little") + 1
+            return None
+        if head[:2] != b"\xff\xd8":
+            return None
+        # Walk the JPEG segments up to the start of frame marker, which holds the dimensions
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None
+            while marker[1] == 0xff:                             # fill bytes before the marker
+                marker = marker[1:] + f.read(1)
+            length = f.read(2)
+            if len(length) < 2:
+                return None
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                h, w = struct.unpack(">xHH", f.read(5))
+                return h, w
+            f.seek(struct.unpack(">H", length)[0] - 2, 1)
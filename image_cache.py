@@ -0,0 +1,105 @@
+import hashlib
+import os
+import threading
+import numpy as np
+import cv2
+
+
+class DecodeCache:
+    """
+    On-disk cache of decoded images stored as raw .npy arrays. Entries are keyed by the source path
+    together with its mtime and size, so a changed source never hits a stale entry, and are loaded back
+    zero-copy through np.memmap. The least recently used entries are evicted once the cache outgrows max_bytes.
+    Several processes can share one cache folder, entries are written to a temporary file and renamed.
+    """
+
+    def __init__(self, folder, max_bytes=10 << 30):
+        """
+        :param folder: Folder to keep the decoded images in
+        :param max_bytes: Maximum total size of the cached images
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.total = sum(e.stat().st_size for e in os.scandir(folder) if e.name.endswith(".npy"))
+
+    def _entry(self, path, flags):
+        stat = os.stat(path)
+        key = f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}:{flags}"
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def load(self, path, flags=cv2.IMREAD_COLOR):
+        """
+        Loads a decoded image from the cache, decoding and caching it on a miss
+        :param path: Path of the source image
+        :param flags: cv2.imread flags used to decode the image
+        :return: Decoded image, read-only and memory-mapped on a hit, None if the image can't be read
+        """
+        entry = self._entry(path, flags)
+        try:
+            image = np.load(entry, mmap_mode="r")
+            os.utime(entry)                                      # mark as recently used
+            with self.lock:
+                self.hits += 1
+            return image
+        except (OSError, ValueError):
+            pass
+
+        image = cv2.imread(path, flags)
+        with self.lock:
+            self.misses += 1
+        if image is None:
+            return None
+        self._store(entry, image)
+        return image
+
+    def _store(self, entry, image):
+        # Entries of older versions of a source are never hit again and age out through eviction
+        tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, image)
+        os.replace(tmp, entry)
+        with self.lock:
+            self.total += os.path.getsize(entry)
+            over = self.total > self.max_bytes
+        if over:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self.lock:
+            self.total -= size
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in 90% of its size cap
+        """
+        entries = sorted((e.stat().st_mtime, e.stat().st_size, e.path)
+                         for e in os.scandir(self.folder) if e.name.endswith(".npy"))
+        with self.lock:
+            self.total = sum(size for _, size, _ in entries)
+        for _, _, path in entries:
+            if self.total <= self.max_bytes * 0.9:
+                break
+            self._remove(path)
+
+    def take_counts(self):
+        """
+        :return: Hits and misses since the last call, the counters start again from zero
+        """
+        with self.lock:
+            counts = (self.hits, self.misses)
+            self.hits = self.misses = 0
+        return counts
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), {self.total / (1 << 20):.1f} MB cached"
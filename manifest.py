@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def file_signature(path):
+    """
+    Cheap identity of a file's contents
+    :param path: Path of the file
+    :return: [mtime in nanoseconds, size in bytes] of the file
+    """
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def config_hash(config):
+    """
+    Hashes the settings that influence the augmented outputs
+    :param config: JSON serializable dictionary of the settings
+    :return: Hex digest of the settings
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class Manifest:
+    """
+    Append-only JSON lines log of the sources an augmentation run has completed. Each record holds the
+    source and annotation signatures, the config hash, the seed and the outputs produced. Records are
+    appended as sources complete, so an interrupted run keeps everything it finished. A source keeps one
+    record per config, the last one appended wins, and a record drops the records of other configs whose
+    outputs it overwrote.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        # Seed of the last appended record of every config, records of other configs may come later
+        self.seeds = {}
+        self.produced = set()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue                                 # a line cut short by an interrupted run
+                    self._add(record)
+        self.file = None
+
+    def _add(self, record):
+        configs = self.records.setdefault(record["source"], {})
+        outputs = set(record["outputs"])
+        for config in [config for config, other in configs.items() if outputs.intersection(other["outputs"])]:
+            del configs[config]
+        configs[record["config"]] = record
+        self.seeds[record["config"]] = record["seed"]
+        self.produced.update(outputs)
+
+    def outputs(self):
+        """
+        :return: Set of every output path listed in the manifest, including the ones of superseded records
+        """
+        return set(self.produced)
+
+    def seed_for(self, config):
+        """
+        :param config: Config hash of the run
+        :return: Seed of the last recorded run with the same config, None if there is none
+        """
+        return self.seeds.get(config)
+
+    def is_complete(self, source, annotation, config, seed):
+        """
+        Checks whether a source was already augmented with the same config and seed, and its outputs are intact
+        :param source: Path of the source image
+        :param annotation: Path of the source annotation
+        :param config: Config hash of the run
+        :param seed: Global seed of the run
+        :return: True if the source can be skipped
+        """
+        record = self.records.get(source, {}).get(config)
+        if record is None or record["config"] != config or record["seed"] != seed:
+            return False
+        try:
+            if record["image"] != file_signature(source) or record["annotation"] != file_signature(annotation):
+                return False
+        except OSError:
+            return False
+        return all(os.path.exists(output) for output in record["outputs"])
+
+    def record(self, source, annotation, config, seed, outputs):
+        """
+        Appends the record of a completed source
+        :param source: Path of the source image
+        :param annotation: Path of the source annotation
+        :param config: Config hash of the run
+        :param seed: Global seed of the run
+        :param outputs: Paths of the files produced for the source
+        """
+        record = {"source": source, "image": file_signature(source), "annotation_path": annotation,
+                  "annotation": file_signature(annotation), "config": config, "seed": seed,
+                  "outputs": sorted(set(outputs))}
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            self._add(record)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,140 @@
+import numpy as np
+import cv2
+from functools import lru_cache
+
+
+LUT_CACHE_SIZE = 512
+
+
+@lru_cache(maxsize=LUT_CACHE_SIZE)
+def contrast_lut(gamma):
+    lut = []
+    for i in range(256):
+        lut.append((i / 255) ** gamma * 255)
+    lut = np.uint8(lut)
+    lut.flags.writeable = False
+    return lut
+
+
+@lru_cache(maxsize=LUT_CACHE_SIZE)
+def _hue_lut(shift):
+    lut = np.mod(np.arange(256) + shift, 180).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def hue_lut(dh):
+    # int(mod(h + dh, 180)) only depends on the integer part of dh for integer h, so the cache is keyed on it
+    return _hue_lut(int(np.floor(dh)))
+
+
+@lru_cache(maxsize=LUT_CACHE_SIZE)
+def saturation_lut(ds):
+    lut = np.clip(np.arange(256, dtype=np.uint8) * ds, 0, 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+IDENTITY_LUT = np.arange(256, dtype=np.uint8)
+
+
+def hsv_lut(dh, ds):
+    """
+    Builds the per-channel table that shifts hue and scales saturation of an HSV image in one cv2.LUT pass
+    :param dh: Hue shift
+    :param ds: Saturation multiplier
+    :return: (256, 1, 3) uint8 table for the H, S and V planes
+    """
+    return np.stack([hue_lut(dh), saturation_lut(ds), IDENTITY_LUT], axis=-1).reshape(256, 1, 3)
+
+
+def compose_luts(first, second):
+    """
+    Composes two lookup tables, applying the result equals applying first and then second
+    :param first: Table applied first
+    :param second: Table applied second
+    :return: Composed table
+    """
+    return np.take_along_axis(second, first.astype(np.intp), axis=0)
+
+
+def photometric_stages(ops):
+    """
+    Turns pointwise color operations into as few lookup table passes as possible
+    :param ops: List of ("hsv", (dh, ds)) and ("contrast", (gamma,)) tuples, in the order they are applied
+    :return: List of ("hsv", lut) and ("bgr", lut) stages, consecutive BGR operations are composed
+    """
+    stages = []
+    for op, params in ops:
+        if op == "hsv":
+            space, lut = "hsv", hsv_lut(*params)
+        elif op == "contrast":
+            space, lut = "bgr", contrast_lut(*params)
+        else:
+            raise ValueError(f"Unknown photometric operation '{op}'")
+        # Back to back BGR tables compose exactly, HSV ones do not as the BGR round trip in between is lossy
+        if space == "bgr" and stages and stages[-1][0] == "bgr":
+            stages[-1] = (space, compose_luts(stages[-1][1], lut))
+        else:
+            stages.append((space, lut))
+    return stages
+
+
+def apply_photometric(image, ops, dst=None):
+    """
+    Applies pointwise color operations with one cv2.LUT pass per stage
+    :param image: BGR image
+    :param ops: List of ("hsv", (dh, ds)) and ("contrast", (gamma,)) tuples, in the order they are applied
+    :param dst: Optional preallocated output, may be image itself to work in place
+    :return: Resulting BGR image
+    """
+    for space, lut in photometric_stages(ops):
+        if space == "hsv":
+            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=dst)
+            cv2.LUT(hsv, lut, dst=hsv)
+            image = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=hsv)
+        else:
+            image = cv2.LUT(image, lut, dst=dst)
+        # Every later stage reads and writes the output of this one
+        dst = image
+    return image
+
+
+def _lut_batch(src, luts, dst):
+    # Samples sharing a table go through cv2.LUT together, the others one by one into their slice of dst
+    batch, height, width, channels = src.shape
+    keys = [lut.tobytes() for lut in luts]
+    if len(set(keys)) == 1:
+        cv2.LUT(src.reshape(batch * height, width, channels), luts[0],
+                dst=dst.reshape(batch * height, width, channels))
+    else:
+        for i, lut in enumerate(luts):
+            cv2.LUT(src[i], lut, dst=dst[i])
+    return dst
+
+
+def apply_photometric_batch(images, ops_per_image):
+    """
+    Applies pointwise color operations with per-sample parameters to a batch of same-size images
+    :param images: (B, H, W, 3) BGR images
+    :param ops_per_image: One list of operations per image, as taken by apply_photometric,
+                          every list must hold the same operations in the same order
+    :return: (B, H, W, 3) resulting images, equal to apply_photometric on every image
+    """
+    images = np.ascontiguousarray(images)
+    batch, height, width, channels = images.shape
+    stages = [photometric_stages(ops) for ops in ops_per_image]
+    out = np.empty_like(images)
+    src = images
+    for s, (space, _) in enumerate(stages[0]):
+        luts = [sample_stages[s][1] for sample_stages in stages]
+        if space == "hsv":
+            # Color conversions are pointwise, the whole batch converts in a single call
+            rows = (batch * height, width, channels)
+            cv2.cvtColor(src.reshape(rows), cv2.COLOR_BGR2HSV, dst=out.reshape(rows))
+            _lut_batch(out, luts, out)
+            cv2.cvtColor(out.reshape(rows), cv2.COLOR_HSV2BGR, dst=out.reshape(rows))
+        else:
+            _lut_batch(src, luts, out)
+        src = out
+    return src.copy() if src is images else src
@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0       # time spent waiting for input from the previous stage
+        self.blocked = 0.0       # time spent waiting for room in the queue of the next stage
+        self.lock = threading.Lock()
+
+    def add(self, items=0, busy=0.0, starved=0.0, blocked=0.0):
+        with self.lock:
+            self.items += items
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+
+    def summary(self):
+        return f"{self.name:<8} threads={self.threads:<3} items={self.items:<7} busy={self.busy:8.2f}s " \
+               f"starved={self.starved:8.2f}s blocked={self.blocked:8.2f}s"
+
+
+class Pipeline:
+    """
+    Streams jobs through reader, augmentation and writer stages that run on their own threads.
+    Stages are connected by bounded queues, so at most queue_depth items wait between two stages
+    no matter how large the dataset is.
+    """
+
+    def __init__(self, read, augment, write, reader_threads=2, augment_threads=4, writer_threads=2,
+                 queue_depth=8):
+        """
+        :param read: Callable taking a job and returning an iterable of decoded items
+        :param augment: Callable taking a decoded item and returning an item to write
+        :param write: Callable taking an augmented item and writing it out
+        :param reader_threads: Number of threads decoding the sources
+        :param augment_threads: Number of threads running the augmentations
+        :param writer_threads: Number of threads encoding and writing the results
+        :param queue_depth: Maximum number of items waiting between two stages
+        """
+        self.stages = [(read, StageStats("read", reader_threads), True),
+                       (augment, StageStats("augment", augment_threads), False),
+                       (write, StageStats("write", writer_threads), False)]
+        self.queue_depth = queue_depth
+        self.failed = threading.Event()
+        self.errors = []
+
+    @property
+    def stats(self):
+        return [stats for _, stats, _ in self.stages]
+
+    def _put(self, q, item, stats):
+        start = time.perf_counter()
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats.add(blocked=time.perf_counter() - start)
+
+    def _get(self, q, stats):
+        start = time.perf_counter()
+        while not self.failed.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        else:
+            item = _DONE
+        stats.add(starved=time.perf_counter() - start)
+        return item
+
+    def _worker(self, fn, stats, expand, inq, outq, finished, downstream_threads):
+        try:
+            while True:
+                item = self._get(inq, stats)
+                if item is _DONE:
+                    break
+                start = time.perf_counter()
+                if expand:
+                    for result in fn(item):
+                        stats.add(items=1, busy=time.perf_counter() - start)
+                        self._put(outq, result, stats)
+                        start = time.perf_counter()
+                    stats.add(busy=time.perf_counter() - start)
+                else:
+                    result = fn(item)
+                    stats.add(items=1, busy=time.perf_counter() - start)
+                    if outq is not None:
+                        self._put(outq, result, stats)
+        except BaseException as e:
+            self.errors.append(e)
+            self.failed.set()
+        finally:
+            # The last thread of a stage tells every thread of the next stage to stop
+            with stats.lock:
+                finished[0] += 1
+                last = finished[0] == stats.threads
+            if last and outq is not None:
+                for _ in range(downstream_threads):
+                    self._put(outq, _DONE, stats)
+
+    def run(self, jobs):
+        queues = [queue.Queue(self.queue_depth) for _ in self.stages] + [None]
+        threads = []
+        for s, (fn, stats, expand) in enumerate(self.stages):
+            downstream_threads = self.stages[s + 1][1].threads if s + 1 < len(self.stages) else 0
+            finished = [0]
+            for _ in range(stats.threads):
+                threads.append(threading.Thread(target=self._worker, daemon=True,
+                                                args=(fn, stats, expand, queues[s], queues[s + 1], finished,
+                                                      downstream_threads)))
+        for t in threads:
+            t.start()
+
+        feed_stats = StageStats("feed", 1)
+        for job in jobs:
+            self._put(queues[0], job, feed_stats)
+            if self.failed.is_set():
+                break
+        for _ in range(self.stages[0][1].threads):
+            self._put(queues[0], _DONE, feed_stats)
+
+        for t in threads:
+            t.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.stats
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+import numpy as np
+
+
+# Sampling bounds of every augmentation, a policy lists the augmentations to apply and overrides these
+DEFAULT_POLICY = {
+    "rotation": {"min": -90, "max": 90},
+    "perspective": {"max": 130},
+    "flip": {"directions": ["h", "v"]},
+    "bilateral": {"diameter": 23, "sigma_color": 98, "sigma_space": 88},
+    "gaussian": {"kernel": [1, 9], "sigma": 25},
+    "hsv": {"hue": [34, 86], "saturation": [1.2, 3.7]},
+    "contrast": {"gamma": 0.75},
+    "sharpness": {"kernel_sizes": [3, 5, 7, 9, 11, 13, 17, 19, 23], "sigma": [5, 100]},
+    "shift": {"min": -10, "max": 10},
+    "saltpepper": {"max": 0.001},
+}
+
+# Settings without a default, they are only part of a policy that sets them
+OPTIONAL_SETTINGS = {
+    "rotation": ["step"],
+    "shift": ["step"],
+}
+
+# Stored parameters of every augmentation, in the order they are passed to the augmentation
+PLAN_FIELDS = {
+    "rotation": [("angle", np.float32)],
+    "perspective": [("dx1", np.int16), ("dx2", np.int16), ("dy1", np.int16), ("dy2", np.int16)],
+    "flip": [("direction", np.uint8)],
+    "bilateral": [("diameter", np.int16), ("sigma_color", np.int16), ("sigma_space", np.int16)],
+    "gaussian": [("kw", np.int16), ("kh", np.int16), ("sigma", np.float32)],
+    "hsv": [("dh", np.float32), ("ds", np.float32)],
+    "contrast": [("gamma", np.float32)],
+    "sharpness": [("ksize", np.int16), ("sigma", np.int16)],
+    "shift": [("tx", np.float32), ("ty", np.float32)],
+    "saltpepper": [("intensity", np.float32)],
+}
+
+
+def resolve_policy(policy):
+    """
+    Fills in the default bounds of a policy
+    :param policy: Dictionary of augmentation name to a dictionary of the bounds to override, or None
+    :return: Policy with the bounds of every listed augmentation, in the order they are applied
+    """
+    for op, bounds in policy.items():
+        if op not in DEFAULT_POLICY:
+            raise ValueError(f"Unknown augmentation '{op}' in the policy, expected one of {list(DEFAULT_POLICY)}")
+        known = list(DEFAULT_POLICY[op]) + OPTIONAL_SETTINGS.get(op, [])
+        unknown = set(bounds or {}) - set(known)
+        if unknown:
+            raise ValueError(f"Unknown settings {sorted(unknown)} for '{op}', expected {known}")
+    return {op: {**DEFAULT_POLICY[op], **(policy[op] or {})} for op in DEFAULT_POLICY if op in policy}
+
+
+@lru_cache(maxsize=8)
+def _read_policy(path, mtime):
+    with open(path, "r") as f:
+        if path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading YAML policies needs PyYAML, install it or write the policy as JSON")
+            policy = yaml.safe_load(f)
+        else:
+            policy = json.load(f)
+    return resolve_policy(policy.get("augmentations", policy))
+
+
+def load_policy(path):
+    """
+    Reads a policy from a JSON or YAML file, such as {"augmentations": {"rotation": {"min": -30, "max": 30}, "hsv": {}}}
+    :param path: Path of the policy file
+    :return: Resolved policy
+    """
+    return _read_policy(path, os.stat(path).st_mtime_ns)
+
+
+def quantize(value, step=None):
+    """
+    Rounds sampled values onto a grid, so transforms repeat and whole-pixel ones can skip resampling
+    :param value: Value or array of values
+    :param step: Spacing of the grid, None keeps the values as they are
+    :return: Rounded value or values
+    """
+    return np.round(np.asarray(value) / step) * step if step else value
+
+
+def sample_plan_parameters(policy, count, rng):
+    """
+    Samples the parameters of count augmentations at once
+    :param policy: Resolved policy
+    :param count: Number of augmentations
+    :param rng: np.random.Generator
+    :return: Dictionary of "<augmentation>.<parameter>" to an array of count values
+    """
+    columns = {}
+    for op, bounds in policy.items():
+        if op == "rotation" or op == "shift":
+            values = [quantize(rng.uniform(bounds["min"], bounds["max"], count), bounds.get("step"))
+                      for _ in PLAN_FIELDS[op]]
+        elif op == "perspective":
+            values = list(rng.integers(0, bounds["max"], (4, count)))
+        elif op == "flip":
+            values = [rng.integers(0, len(bounds["directions"]), count)]
+        elif op == "bilateral":
+            values = [rng.integers(0, bounds[name], count) for name in ("diameter", "sigma_color", "sigma_space")]
+        elif op == "gaussian":
+            odd = (bounds["kernel"][1] - bounds["kernel"][0] + 1) // 2
+            values = [rng.integers(0, odd, count) * 2 + bounds["kernel"][0] for _ in range(2)]
+            values.append(rng.uniform(0, bounds["sigma"], count))
+        elif op == "hsv":
+            values = [rng.uniform(*bounds["hue"], count), rng.uniform(*bounds["saturation"], count)]
+        elif op == "contrast":
+            values = [np.full(count, bounds["gamma"])]
+        elif op == "sharpness":
+            values = [np.asarray(bounds["kernel_sizes"])[rng.integers(0, len(bounds["kernel_sizes"]), count)],
+                      rng.integers(bounds["sigma"][0], bounds["sigma"][1] + 1, count)]
+        else:
+            values = [rng.uniform(0, bounds["max"], count)]
+        for (name, _), value in zip(PLAN_FIELDS[op], values):
+            columns[f"{op}.{name}"] = value
+    return columns
+
+
+class Plan:
+    """
+    Every augmentation of a run sampled up front: the sources, and per work unit its source, aug_iter,
+    noise seed and augmentation parameters in one structured array. Executing a plan needs no sampling,
+    so any slice of it gives the same outputs on any machine.
+    """
+
+    def __init__(self, images, annotations, keys, units, policy, seed):
+        self.images = images
+        self.annotations = annotations
+        self.keys = keys
+        self.units = units
+        self.policy = policy
+        self.seed = seed
+        self.rows = {(keys[source], aug_iter): i
+                     for i, (source, aug_iter) in enumerate(zip(units["source"].tolist(), units["aug_iter"].tolist()))}
+
+    def __len__(self):
+        return len(self.units)
+
+    def digest(self):
+        return hashlib.sha1(self.units.tobytes() + json.dumps(self.policy, sort_keys=True).encode()).hexdigest()
+
+    def parameters(self, key, aug_iter):
+        """
+        :param key: Source key of the image
+        :param aug_iter: Augmentation number of the image
+        :return: Parameters in the layout of augment.sample_parameters, and the seed of the noise
+        """
+        row = self.units[self.rows[(key, aug_iter)]]
+        params = {}
+        for op in self.policy:
+            values = tuple(row[f"{op}.{name}"].item() for name, _ in PLAN_FIELDS[op])
+            params[op] = (self.policy[op]["directions"][values[0]],) if op == "flip" else values
+        return params, int(row["seed"])
+
+    def select(self, shard_index=0, num_shards=1):
+        """
+        Slices the plan by source, so each image is decoded on one node only
+        :param shard_index: Index of this slice
+        :param num_shards: Number of slices
+        :return: List of (source index, image path, annotation path, aug_iter) work units
+        """
+        sources = self.units["source"].tolist()
+        aug_iters = self.units["aug_iter"].tolist()
+        return [(s, self.images[s], self.annotations[s], a) for s, a in zip(sources, aug_iters)
+                if s % num_shards == shard_index]
+
+    def save(self, path):
+        meta = {"images": self.images, "annotations": self.annotations, "keys": self.keys, "policy": self.policy,
+                "seed": self.seed}
+        with open(path, "wb") as f:
+            np.savez_compressed(f, units=self.units, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(data["meta"].tobytes().decode())
+            return cls(meta["images"], meta["annotations"], meta["keys"], data["units"], meta["policy"], meta["seed"])
+
+
+def compile_plan(pairs, keys, policy, seed, augs=1, rand_augs=False):
+    """
+    Samples the parameters of every augmentation of a run in a few vectorized draws
+    :param pairs: List of (image path, annotation path) sources
+    :param keys: Source key of every source
+    :param policy: Resolved policy
+    :param seed: Random seed of the plan
+    :param augs: Number of augmentations for each image, the maximum with rand_augs
+    :param rand_augs: Use this flag to draw the number of augmentations of each image between 1 and augs
+    :return: Plan
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(1, augs + 1, len(pairs)) if rand_augs else np.full(len(pairs), augs)
+    total = int(counts.sum())
+    fields = [("source", np.int32), ("aug_iter", np.int32), ("seed", np.uint32)]
+    fields += [(f"{op}.{name}", dtype) for op in policy for name, dtype in PLAN_FIELDS[op]]
+    units = np.zeros(total, dtype=fields)
+    units["source"] = np.repeat(np.arange(len(pairs)), counts)
+    units["aug_iter"] = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    units["seed"] = rng.integers(0, 2 ** 32, total, dtype=np.uint64)
+    for column, values in sample_plan_parameters(policy, total, rng).items():
+        units[column] = values
+    return Plan([i for i, _ in pairs], [a for _, a in pairs], list(keys), units, policy, seed)
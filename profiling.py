@@ -0,0 +1,76 @@
+import csv
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+
+FIELDS = ["stage", "item", "seconds", "pixels", "params"]
+
+
+class Profiler:
+    """
+    Records wall time, pixel counts and parameters of every stage of a run.
+    Records are plain tuples, so worker processes can send theirs back to be merged.
+    """
+
+    def __init__(self):
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, image=None, params=None, item=None):
+        # Stages that only know their image once done, like decoding, can set "pixels" on the yielded dict
+        extra = {"pixels": image.shape[0] * image.shape[1] if image is not None else 0}
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            # list.append is atomic, so pipeline threads can share one profiler
+            self.records.append((name, item, time.perf_counter() - start, extra["pixels"], params))
+
+    def merge(self, records):
+        self.records.extend(records)
+
+    def totals(self):
+        totals = {}
+        for name, _, seconds, pixels, _ in self.records:
+            count, total_seconds, total_pixels = totals.get(name, (0, 0.0, 0))
+            totals[name] = (count + 1, total_seconds + seconds, total_pixels + pixels)
+        return totals
+
+    def summary(self, top=10):
+        totals = sorted(self.totals().items(), key=lambda kv: kv[1][1], reverse=True)
+        overall = sum(seconds for _, (_, seconds, _) in totals) or 1.0
+        lines = [f"{'stage':<14} {'calls':>8} {'total s':>10} {'share':>7} {'mean ms':>10} {'MP/s':>9}"]
+        for name, (count, seconds, pixels) in totals[:top]:
+            mpx = f"{pixels / 1e6 / seconds:9.1f}" if pixels and seconds else f"{'-':>9}"
+            lines.append(f"{name:<14} {count:>8} {seconds:>10.2f} {seconds / overall:>7.1%} "
+                         f"{seconds / count * 1e3:>10.2f} {mpx}")
+        return "\n".join(lines)
+
+    def save(self, path):
+        rows = [dict(zip(FIELDS, record)) for record in self.records]
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                writer.writeheader()
+                for row in rows:
+                    row["params"] = " ".join(map(str, row["params"] or ()))
+                    writer.writerow(row)
+        else:
+            with open(path, "w") as f:
+                json.dump({"totals": {name: {"calls": c, "seconds": s, "pixels": p}
+                                      for name, (c, s, p) in self.totals().items()},
+                           "records": rows}, f, default=str)
+
+
+class NullProfiler:
+    records = ()
+
+    def stage(self, name, image=None, params=None, item=None):
+        return nullcontext({})
+
+    def merge(self, records):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,236 @@
+import io
+import glob
+import json
+import mmap
+import os
+import tarfile
+import threading
+import numpy as np
+import cv2
+from helpers import as_annotations
+
+
+SHARD_PATTERN = "{prefix}-{number:05d}.tar"
+INDEX_SUFFIX = ".idx"
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def shard_files(folder, prefix="*"):
+    """
+    Lists the shards of a folder together with their indexes
+    :param folder: Folder containing the shards
+    :param prefix: Prefix of the shards, all shards if omitted
+    :return: Sorted list of shard and index paths
+    """
+    shards = sorted(glob.glob(os.path.join(folder, f"{prefix}-[0-9][0-9][0-9][0-9][0-9].tar")))
+    return shards + [s + INDEX_SUFFIX for s in shards if os.path.exists(s + INDEX_SUFFIX)]
+
+
+def rebuild_index(path):
+    """
+    Scans the tar headers of a shard whose writer was interrupted before it wrote the index, and saves the index
+    :param path: Path of the shard
+    :return: Index of the samples whose members were written completely
+    """
+    size = os.path.getsize(path)
+    index = {}
+    try:
+        with tarfile.open(path, "r:") as tar:
+            for info in tar:
+                if info.offset_data + info.size > size:
+                    break
+                key, _, ext = info.name.rpartition(".")
+                index.setdefault(key, {})[ext] = [info.offset_data, info.size]
+    except tarfile.ReadError:
+        pass                                                     # a header cut short by the interruption
+    # The last sample may be missing members that were never written
+    index = {key: entry for key, entry in index.items() if "txt" in entry and len(entry) > 1}
+    try:
+        with open(path + INDEX_SUFFIX, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+    except OSError:
+        pass                                                     # read-only folders keep the index in memory
+    return index
+
+
+def recover_shards(folder, prefix="*", referenced=()):
+    """
+    Repairs the shards an interrupted run left without an index, before the run is resumed
+    :param folder: Folder containing the shards
+    :param prefix: Prefix of the shards of the run
+    :param referenced: Absolute paths of the shards holding samples of completed sources
+    :return: List of removed shards, they only held samples of sources the resumed run writes again
+    """
+    removed = []
+    for path in shard_files(folder, prefix):
+        if not path.endswith(".tar") or os.path.exists(path + INDEX_SUFFIX):
+            continue
+        if os.path.abspath(path) in referenced:
+            rebuild_index(path)
+        else:
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def shard_number(path):
+    return int(path[-len("00000.tar"):-len(".tar")])
+
+
+class ShardWriter:
+    """
+    Writes samples into size-bounded tar shards. Every sample is stored as "<key>.<ext>" members,
+    and each shard gets a JSON index of member offsets so readers do not have to scan the tar.
+    """
+
+    def __init__(self, folder, prefix="augmented", max_bytes=1 << 30):
+        """
+        :param folder: Folder to write the shards to
+        :param prefix: Prefix of the shard file names
+        :param max_bytes: Size at which a new shard is started
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        # Numbers continue after the highest existing shard, removed shards leave gaps that are not reused
+        self.number = max((shard_number(p) + 1 for p in shard_files(folder, prefix) if p.endswith(".tar")),
+                          default=0)
+        self.tar = None
+        self.index = {}
+        self.paths = []
+        self.lock = threading.Lock()
+
+    def _open(self):
+        path = os.path.join(self.folder, SHARD_PATTERN.format(prefix=self.prefix, number=self.number))
+        self.number += 1
+        self.tar = tarfile.open(path, "w")
+        self.index = {}
+        self.paths.append(path)
+
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        path = self.tar.name
+        self.tar.close()
+        with open(path + INDEX_SUFFIX, "w") as f:
+            json.dump(self.index, f, separators=(",", ":"))
+        self.tar = None
+
+    def write(self, key, members):
+        """
+        Adds one sample to the current shard
+        :param key: Unique name of the sample
+        :param members: Dictionary of extension to bytes, for example {"jpg": ..., "txt": ...}
+        :return: Path of the shard the sample went to
+        """
+        size = sum(BLOCK_SIZE + -(-len(data) // BLOCK_SIZE) * BLOCK_SIZE for data in members.values())
+        with self.lock:
+            if self.tar is None or (self.index and self.tar.offset + size > self.max_bytes):
+                self._close_shard()
+                self._open()
+            entry = {}
+            for ext, data in members.items():
+                info = tarfile.TarInfo(f"{key}.{ext}")
+                info.size = len(data)
+                self.tar.addfile(info, io.BytesIO(data))
+                # The data sits right before the end of the padded member that was just written
+                entry[ext] = [self.tar.offset - -(-len(data) // BLOCK_SIZE) * BLOCK_SIZE, len(data)]
+            self.index[key] = entry
+            return self.tar.name
+
+    def close(self):
+        with self.lock:
+            self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardReader:
+    """
+    Memory-maps a shard and gives random access to its samples by key.
+    """
+
+    def __init__(self, path):
+        if os.path.exists(path + INDEX_SUFFIX):
+            with open(path + INDEX_SUFFIX, "r") as f:
+                self.index = json.load(f)
+        else:
+            self.index = rebuild_index(path)
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.index else b""
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        """
+        :param key: Name of the sample
+        :return: Dictionary of extension to a zero-copy memoryview of the member bytes
+        """
+        view = memoryview(self.map)
+        return {ext: view[offset:offset + size] for ext, (offset, size) in self.index[key].items()}
+
+    def load(self, key):
+        """
+        Decodes an image sample
+        :param key: Name of the sample
+        :return: Decoded image and (N, 5) annotations
+        """
+        members = self[key]
+        encoded = next(data for ext, data in members.items() if ext != "txt")
+        image = cv2.imdecode(np.frombuffer(encoded, dtype=np.uint8), cv2.IMREAD_COLOR)
+        annotations = as_annotations(np.array(bytes(members["txt"]).split(), dtype=np.float32))
+        return image, annotations
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ShardSet:
+    """
+    Random access by key over every shard of a folder. A key written again by a resumed run is read from
+    the newest shard holding it.
+    """
+
+    def __init__(self, folder, prefix="*"):
+        self.readers = [ShardReader(p) for p in shard_files(folder, prefix) if p.endswith(".tar")]
+        self.owner = {key: reader for reader in self.readers for key in reader.keys()}
+
+    def __len__(self):
+        return len(self.owner)
+
+    def __contains__(self, key):
+        return key in self.owner
+
+    def keys(self):
+        return self.owner.keys()
+
+    def __getitem__(self, key):
+        return self.owner[key][key]
+
+    def load(self, key):
+        return self.owner[key].load(key)
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from utils import as_annotations, augmentate_flip, augmentate_geometric, augmentate_rotation
+
+
+ANNOTATIONS = as_annotations(np.array([[0, 0.3, 0.4, 0.2, 0.1], [1, 0.7, 0.6, 0.1, 0.3], [2, 0.1, 0.9, 0.2, 0.2]]))
+
+
+@pytest.mark.parametrize("flipdir", ["h", "v"])
+def test_fused_flip_matches_sequential_flip(flipdir):
+    image = np.random.default_rng(0).integers(0, 256, (100, 160, 3), dtype=np.uint8)
+    fused_img, fused_ann = augmentate_geometric(image, ANNOTATIONS, flipdir=flipdir)
+    flipped_img, flipped_ann = augmentate_flip(image, ANNOTATIONS, flipdir)
+    np.testing.assert_array_equal(fused_img, flipped_img)
+    np.testing.assert_allclose(fused_ann, flipped_ann, atol=1e-6)
+
+
+def test_fused_rotation_and_flip_match_sequential_ops():
+    # Boxes away from the borders, sequential ops clip them after every step and the fused warp only once
+    image, inner = np.zeros((100, 160, 3), dtype=np.uint8), ANNOTATIONS[:2]
+    _, fused_ann = augmentate_geometric(image, inner, angle=30, flipdir="h")
+    rotated_img, rotated_ann = augmentate_rotation(image, inner, 30)[:2]
+    _, flipped_ann = augmentate_flip(rotated_img, rotated_ann, "h")
+    np.testing.assert_allclose(fused_ann, flipped_ann, atol=1e-6)
@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+import pytest
+from augment import parse_args, run
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    (tmp_path / "images").mkdir()
+    (tmp_path / "annotations").mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(4):
+        cv2.imwrite(str(tmp_path / "images" / f"img{i}.jpg"), rng.integers(0, 256, (48, 64, 3), dtype=np.uint8))
+        (tmp_path / "annotations" / f"img{i}.txt").write_text("0 0.5 0.5 0.2 0.2\n")
+    return tmp_path
+
+
+def augment(dataset, *flags):
+    args = parse_args(["--folder-images", str(dataset / "images"), "--folder-anns", str(dataset / "annotations"),
+                       "--manifest", str(dataset / "manifest.jsonl"), "--index-cache", "", "--augs", "2",
+                       *flags])
+    return args, run(args)
+
+
+def test_switching_configs_back_skips_finished_sources(dataset):
+    config_a = ["--hsv", "--output-shards", str(dataset / "shards_a")]
+    config_b = ["--flip", "--output-shards", str(dataset / "shards_b")]
+    args_a, first = augment(dataset, *config_a)
+    augment(dataset, *config_b)
+    args_again, again = augment(dataset, *config_a)
+    assert first.completed == 8
+    assert again.completed == 0
+    assert args_again.seed == args_a.seed
+
+
+def test_overwritten_outputs_are_augmented_again_with_the_same_seed(dataset):
+    output = dataset / "images" / "img0_augmented_0.jpg"
+    args_a, _ = augment(dataset, "--hsv")
+    original = output.read_bytes()
+    augment(dataset, "--flip")
+    args_again, again = augment(dataset, "--hsv")
+    assert again.completed == 8
+    assert args_again.seed == args_a.seed
+    assert output.read_bytes() == original
+
+
+def test_shard_size_is_not_part_of_the_config(dataset):
+    augment(dataset, "--hsv", "--output-shards", str(dataset / "shards"))
+    _, again = augment(dataset, "--hsv", "--output-shards", str(dataset / "shards"), "--shard-size", "0.01")
+    assert again.completed == 0
+
+
+def test_batch_size_is_not_part_of_the_config(dataset):
+    args, first = augment(dataset, "--hsv", "--gaussian")
+    args_again, again = augment(dataset, "--hsv", "--gaussian", "--batch-size", "4")
+    assert first.completed == 8
+    assert again.completed == 0
+    assert args_again.seed == args.seed
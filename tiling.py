@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def tile_grid(height, tile_rows):
+    """
+    :param height: Height of the image
+    :param tile_rows: Number of rows of a tile, the last tile may be smaller
+    :return: List of (y0, y1) tiles covering the image
+    """
+    return [(y, min(y + tile_rows, height)) for y in range(0, height, tile_rows)]
+
+
+def kernel_halo(kw, kh, sigma_x=0, sigma_y=0):
+    # OpenCV derives the kernel size from sigma when it is not given, for 8 bit images
+    kh = kh if kh > 0 else int(round((sigma_y or sigma_x) * 6 + 1)) | 1
+    return kh // 2
+
+
+def bilateral_halo(dist, sspace):
+    # Without a diameter the filter radius is 1.5 * sigma_space, one more pixel covers OpenCV's rounding
+    return dist // 2 if dist > 0 else int(max(sspace, 1) * 1.5) + 1
+
+
+def apply_tiled(op, image, halo=0, dst=None, tile_rows=1024, threads=1):
+    """
+    Runs an image op tile by tile, each tile is read with halo extra rows above and below so the op sees
+    the same neighborhood as on the whole image, and only tile-sized temporaries are allocated.
+    Tiles span the full width: OpenCV's vectorized and scalar code paths can round differently, and
+    splitting rows would move pixels between them and leave seams. Rows processed whole match exactly.
+    :param op: Function of an image region returning the processed region of the same size
+    :param image: Image to process
+    :param halo: Rows read around every tile, at least the vertical kernel radius of the op
+    :param dst: Preallocated or memory-mapped output, may be image itself only for pointwise ops
+    :param tile_rows: Number of rows of a tile
+    :param threads: Number of threads processing tiles, tiles write disjoint parts of dst
+    :return: dst holding the processed image
+    """
+    height = image.shape[0]
+    if dst is None:
+        dst = np.empty_like(image)
+    if dst is image and halo:
+        raise ValueError("Ops with a halo can't work in place, the neighbors of later tiles would be overwritten")
+
+    def run(tile):
+        y0, y1 = tile
+        top, bottom = max(0, y0 - halo), min(height, y1 + halo)
+        dst[y0:y1] = op(image[top:bottom])[y0 - top:y1 - top]
+
+    tiles = tile_grid(height, tile_rows)
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(run, tiles))
+    else:
+        for tile in tiles:
+            run(tile)
+    return dst
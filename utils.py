@@ -1,134 +1,238 @@
 import numpy as np
 import cv2
 import random
+from functools import lru_cache
 from helpers import *
+from photometric import *
+from fast_filters import *
 
 
 COLOR = (0, 122, 255)
 THICKNESS = 4
-
-
-def augmentate_rotation(image, annotations, angle=45):
+# Homographies are cached per image size and transform, quantized rotations and shifts repeat across images
+GEOMETRY_CACHE_SIZE = 1024
+# JPEG decoders can skip most of the IDCT work and decode straight at 1/8, 1/4 or 1/2 of the size
+REDUCED_READ_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                      (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def target_dims(height, width, target_size):
+    """
+    Computes the size of an image downscaled so its longer side is target_size
+    :param height: Height of the image
+    :param width: Width of the image
+    :param target_size: Longer side of the result, images that are already smaller are kept as they are
+    :return: Height and width of the result
+    """
+    scale = target_size / max(height, width)
+    if scale >= 1:
+        return height, width
+    return max(1, round(height * scale)), max(1, round(width * scale))
+
+
+def reduced_read_flags(height, width, target_size):
+    """
+    Picks the smallest reduced decode mode that still yields at least target_size pixels on the longer side
+    :param height: Height of the source image
+    :param width: Width of the source image
+    :param target_size: Longer side the image is downscaled to after decoding
+    :return: cv2.imread flags
+    """
+    for factor, flags in REDUCED_READ_FLAGS:
+        if max(height, width) / factor >= target_size:
+            return flags
+    return cv2.IMREAD_COLOR
+
+
+def downscale_image(image, target_size):
+    # Annotations are relative to the image size, so they stay valid without any change
+    height, width = target_dims(*image.shape[:2], target_size)
+    if (height, width) == image.shape[:2]:
+        return image
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def box_corners(corners):
+    # (N, 4) x1, y1, x2, y2 boxes to (N, 4, 2) upper left, upper right, lower left, lower right points
+    x1, y1, x2, y2 = corners[:, 0], corners[:, 1], corners[:, 2], corners[:, 3]
+    return np.stack([np.stack([x1, y1], axis=1), np.stack([x2, y1], axis=1),
+                     np.stack([x1, y2], axis=1), np.stack([x2, y2], axis=1)], axis=1)
+
+
+def transform_corners(points, m):
+    # Maps (N, 4, 2) corner points through a 3x3 homography in a single call
+    if len(points) == 0:
+        return points
+    return cv2.perspectiveTransform(points.reshape(-1, 1, 2).astype(np.float32), m).reshape(-1, 4, 2)
+
+
+def integer_permutation(m):
+    """
+    Recognizes homographies that only move whole pixels: flips, right angle rotations and whole-pixel shifts
+    :param m: 3x3 homography
+    :return: The homography rounded to integers, or None if it resamples the image
+    """
+    rounded = np.rint(m)
+    if np.abs(m - rounded).max() > 1e-9 or rounded[2].tolist() != [0, 0, 1]:
+        return None
+    axes = np.abs(rounded[:2, :2])
+    if not (axes.sum(axis=0) == 1).all() or not (axes.sum(axis=1) == 1).all():
+        return None
+    return rounded.astype(int)
+
+
+def permute_pixels(image, m, out_h, out_w, dst=None):
+    """
+    Applies an integer_permutation by slicing, with the same result as warping the image with it
+    :param image: Image to transform
+    :param m: Homography from integer_permutation
+    :param out_h: Height of the output
+    :param out_w: Width of the output
+    :param dst: Optional preallocated output
+    :return: Transformed image, uncovered pixels are black like in cv2.warpAffine
+    """
+    (a, b, tx), (c, d, ty) = m[:2].tolist()
+    height, width = image.shape[:2]
+    transpose = a == 0
+    if transpose:
+        # Output rows come from image columns and the other way around
+        a, d, height, width = b, c, width, height
+    oy = ty if d == 1 else ty - (height - 1)
+    ox = tx if a == 1 else tx - (width - 1)
+    flip_code = {(-1, 1): 1, (1, -1): 0, (-1, -1): -1}.get((a, d))
+
+    out = np.empty((out_h, out_w) + image.shape[2:], image.dtype) if dst is None else dst
+    # Transposes and flips run in OpenCV, straight into the output when it is exactly covered
+    covers = oy == 0 and ox == 0 and (height, width) == (out_h, out_w)
+    if covers and flip_code is None:
+        if transpose:
+            return cv2.transpose(image, dst=out)
+        np.copyto(out, image)
+        return out
+    view = cv2.transpose(image) if transpose else image
+    if flip_code is not None:
+        view = cv2.flip(view, flip_code, dst=out if covers else None)
+        if covers:
+            return view
+
+    y0, y1 = min(max(oy, 0), out_h), max(min(oy + height, out_h), 0)
+    x0, x1 = min(max(ox, 0), out_w), max(min(ox + width, out_w), 0)
+    if y0 >= y1 or x0 >= x1:
+        out[:] = 0
+        return out
+    out[:y0] = 0
+    out[y1:] = 0
+    out[y0:y1, :x0] = 0
+    out[y0:y1, x1:] = 0
+    out[y0:y1, x0:x1] = view[y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+    return out
+
+
+def augmentate_rotation(image, annotations, angle=45, dst=None):
     height, width = image.shape[:2]
-    image_center = (width / 2, height / 2)
     rotation_angle = angle * np.pi / 180
 
-    rotation_mat = cv2.getRotationMatrix2D(image_center, angle, 1)
-    abs_cos = abs(rotation_mat[0, 0])
-    abs_sin = abs(rotation_mat[0, 1])
-    bound_w = int(height * abs_sin + width * abs_cos)
-    bound_h = int(height * abs_cos + width * abs_sin)
-    rotation_mat[0, 2] += bound_w / 2 - image_center[0]
-    rotation_mat[1, 2] += bound_h / 2 - image_center[1]
-
-    rotated_img = cv2.warpAffine(image, rotation_mat, (bound_w, bound_h))
+    m, bound_h, bound_w = rotation_homography(height, width, angle)
+    permutation = integer_permutation(m)
+    if permutation is not None:
+        rotated_img = permute_pixels(image, permutation, bound_h, bound_w, dst)
+    else:
+        rotated_img = cv2.warpAffine(image, m[:2], (bound_w, bound_h), dst=dst)
     new_height, new_width = rotated_img.shape[:2]
 
     rot_matrix = np.array([[np.cos(rotation_angle), -np.sin(rotation_angle)],
-                           [np.sin(rotation_angle), np.cos(rotation_angle)]])
-
-    new_bbox = []
-    for bbox in annotations:
-        if len(bbox) > 1:
-            (x1, y1, x2, y2) = yolotocv(bbox[1], bbox[2], bbox[3], bbox[4], height, width)
-
-            ul_corner_shift = (x1 - width / 2, y1 - height / 2)
-            ur_corner_shift = (x2 - width / 2, y1 - height / 2)
-            ll_corner_shift = (x1 - width / 2, y2 - height / 2)
-            lr_corner_shift = (x2 - width / 2, y2 - height / 2)
-
-            new_lr_corner = [-1, -1]
-            new_ul_corner = []
-
-            for i in (ul_corner_shift, ur_corner_shift,
-                      ll_corner_shift, lr_corner_shift):
-                new_coords = np.matmul(rot_matrix, np.array((i[0], -i[1])))
-                x_prime, y_prime = new_width / 2 + new_coords[0], new_height / 2 - new_coords[1]
-                if new_lr_corner[0] < x_prime:
-                    new_lr_corner[0] = x_prime
-                if new_lr_corner[1] < y_prime:
-                    new_lr_corner[1] = y_prime
-
-                if len(new_ul_corner) > 0:
-                    if new_ul_corner[0] > x_prime:
-                        new_ul_corner[0] = x_prime
-                    if new_ul_corner[1] > y_prime:
-                        new_ul_corner[1] = y_prime
-                else:
-                    new_ul_corner.append(x_prime)
-                    new_ul_corner.append(y_prime)
-
-            new_bbox.append([int(bbox[0]), *cvtoyolo(new_ul_corner[0], new_ul_corner[1],
-                                                     new_lr_corner[0], new_lr_corner[1], new_height,
-                                                     new_width)])
+                           [np.sin(rotation_angle), np.cos(rotation_angle)]], dtype=np.float32)
+
+    annotations = as_annotations(annotations)
+    corners = box_corners(yolotocv_array(annotations[:, 1:], height, width))
+
+    # Rotate all corners around the image center in a y-up frame, then move them onto the new canvas
+    shifted = (corners - np.float32([width / 2, height / 2])) * np.float32([1, -1])
+    rotated = shifted @ rot_matrix.T
+    rotated = np.float32([new_width / 2, new_height / 2]) + rotated * np.float32([1, -1])
+
+    new_corners = np.hstack([rotated.min(axis=1), rotated.max(axis=1)])
+    new_bbox = np.hstack([annotations[:, :1], cvtoyolo_array(new_corners, new_height, new_width)])
 
     return rotated_img, new_bbox, new_height, new_width
 
 
-def augmentate_perspective(image, annotations, dx1, dx2, dy1, dy2):
+def augmentate_perspective(image, annotations, dx1, dx2, dy1, dy2, dst=None):
     height, width = image.shape[:2]
     pts1 = np.float32([[0, 0], [width, 0], [0, height], [width, height]])
     pts2 = np.float32([[dx1, dy1], [width-dx1, dy2], [dx2, height-dy1], [width-dx2, height-dy2]])
     m = cv2.getPerspectiveTransform(pts1, pts2)
 
-    image = cv2.warpPerspective(image, m, (width, height))
+    image = cv2.warpPerspective(image, m, (width, height), dst=dst)
 
-    new_bbox = []
-    for bbox in annotations:
-        (x_a, y_a, x_b, y_b) = yolotocv(bbox[1], bbox[2], bbox[3], bbox[4], height, width)
+    # Box corners are mirrored about the pixel edges, the pixels about their centers
+    if flipdir is not None:
+        m = geometric_homography(height, width, angle, perspective, flipdir, shift, edges=True)[0]
+    annotations = as_annotations(annotations)
+    new_rect = transform_corners(box_corners(yolotocv_array(annotations[:, 1:], height, width)), m)
 
-        rect_pts = np.array([[[x_a, y_a]], [[x_b, y_a]], [[x_a, y_b]], [[x_b, y_b]]], dtype=np.float32)
-        new_rect = cv2.perspectiveTransform(rect_pts, m)
-
-        new_x_a = new_rect[0][0][0]
-        new_x_b = new_rect[1][0][0]
-        new_y_a = new_rect[0][0][1]
-        new_y_b = new_rect[2][0][1]
-
-        new_bbox.append([int(bbox[0]), *cvtoyolo(new_x_a, new_y_a, new_x_b, new_y_b, height, width)])
+    # Upper left, upper right and lower left corners give the new extents
+    new_corners = np.stack([new_rect[:, 0, 0], new_rect[:, 0, 1], new_rect[:, 1, 0], new_rect[:, 2, 1]], axis=1)
+    new_bbox = np.hstack([annotations[:, :1], cvtoyolo_array(new_corners, height, width)])
 
     return image, new_bbox
 
 
-def augmentate_flip(image, annotations, flipdir="h"):
+def augmentate_flip(image, annotations, flipdir="h", dst=None):
     assert flipdir in ["h", "v"]
     if flipdir == "h":
-        flipped_img = cv2.flip(image, 1)
+        flipped_img = cv2.flip(image, 1, dst=dst)
     else:
-        flipped_img = cv2.flip(image, 0)
-
-    new_bbox = []
-    for bbox in annotations:
-        c, x, y, w, h = bbox
-        if len(bbox) > 1:
-            if flipdir == "h":
-                x = round(1 - x, 6)
-            if flipdir == "v":
-                y = round(1 - y, 6)
-            new_bbox.append([int(c), x, y, w, h])
+        flipped_img = cv2.flip(image, 0, dst=dst)
+
+    new_bbox = as_annotations(annotations).copy()
+    if flipdir == "h":
+        new_bbox[:, 1] = 1 - new_bbox[:, 1]
+    if flipdir == "v":
+        new_bbox[:, 2] = 1 - new_bbox[:, 2]
 
     return flipped_img, new_bbox
 
 
-def augmentate_saltnpeppernoise(image, annotations, noise_intensity):
-    black = np.array([0, 0, 0], dtype="uint8")
-    white = np.array([255, 255, 255], dtype="uint8")
-    probs = np.random.random(image.shape[:2])
-    img = image.copy()                                          # just in case
-    img[probs < (noise_intensity / 2)] = black
-    img[probs > 1 - (noise_intensity / 2)] = white
+def augmentate_saltnpeppernoise(image, annotations, noise_intensity, rng=None, copy=True, dst=None):
+    rng = np.random.default_rng() if rng is None else rng
+    img = image
+    if dst is not None and dst is not image:
+        img = dst
+        np.copyto(img, image)
+    elif copy and dst is None:
+        img = image.copy()                                     # copy=False writes into the caller's buffer
+    height, width = img.shape[:2]
+
+    # Every pixel turns black or white with probability noise_intensity / 2 each, so only draw the corrupted ones
+    count = rng.binomial(height * width, min(max(noise_intensity, 0), 1))
+    corrupted = rng.choice(height * width, count, replace=False)
+    rows, cols = np.divmod(corrupted, width)
+    salt = rng.random(count) < 0.5
+    img[rows[~salt], cols[~salt]] = 0
+    img[rows[salt], cols[salt]] = 255
     return img, annotations
 
 
-def augmentate_bilateral(image, annotations, dist, scolor, sspace):
-    return cv2.bilateralFilter(image, dist, scolor, sspace), annotations
+def augmentate_bilateral(image, annotations, dist, scolor, sspace, dst=None):
+    # The bilateral filter can't work in place, dst must be a different buffer than image
+    return cv2.bilateralFilter(image, dist, scolor, sspace, dst=dst), annotations
+
+
+def augmentate_gaussianblur(image, annotations, kw, kh, sigma, dst=None):
+    return cv2.GaussianBlur(image, (kw, kh), sigma, dst=dst), annotations
+
+
+def augmentate_bilateral_fast(image, annotations, dist, scolor, sspace, dst=None):
+    # Approximate filter for --filter-quality fast, dst must be a different buffer than image
+    return fast_bilateral(image, dist, scolor, sspace, dst=dst), annotations
 
 
-def augmentate_gaussianblur(image, annotations, kw, kh, sigma):
-    return cv2.GaussianBlur(image, (kw, kh), sigma), annotations
+def augmentate_gaussianblur_fast(image, annotations, kw, kh, sigma, dst=None):
+    return fast_gaussian(image, kw, kh, sigma, dst=dst), annotations
 
 
-def augmentate_shift(image, annotations, tx, ty, minobjsize=0.001):
+def augmentate_shift(image, annotations, tx, ty, minobjsize=0.001, dst=None):
     height = image.shape[0]
     width = image.shape[1]
     mx = np.float32([
@@ -136,50 +240,167 @@ def augmentate_shift(image, annotations, tx, ty, minobjsize=0.001):
         [0, 1, ty]
     ])
 
-    new_ann = []
-    for obj, cx, cy, wo, ho in annotations:
-        old_ann = yolotocv(cx, cy, wo, ho, height, width)
-        old_ann[0] = clamp_value(old_ann[0] + tx, 0, width)
-        old_ann[1] = clamp_value(old_ann[1] + ty, 0, height)
-        old_ann[2] = clamp_value(old_ann[2] + tx, 0, width)
-        old_ann[3] = clamp_value(old_ann[3] + ty, 0, height)
-        new_dims = cvtoyolo(*old_ann, height, width)
-        if new_dims[2] > minobjsize and new_dims[3] > minobjsize:
-            new_ann.append([obj] + cvtoyolo(*old_ann, height, width))
-
-    shifted = cv2.warpAffine(image, mx, (width, height))
+    annotations = as_annotations(annotations)
+    corners = yolotocv_array(annotations[:, 1:], height, width) + np.float32([tx, ty, tx, ty])
+    new_ann = clip_boxes(annotations[:, 0], corners, height, width, minobjsize)
+
+    if float(tx).is_integer() and float(ty).is_integer():
+        # Whole-pixel shifts are copies, warping would only interpolate with weights of 0 and 1
+        shifted = permute_pixels(image, np.array([[1, 0, int(tx)], [0, 1, int(ty)], [0, 0, 1]]), height, width, dst)
+    else:
+        shifted = cv2.warpAffine(image, mx, (width, height), dst=dst)
     return shifted, new_ann
 
 
-def augmentate_hsv(image, annotations, dh, ds):
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    h, s, v = cv2.split(image)
-    h = np.mod(h + dh, 180).astype(np.uint8)
-    s = np.clip(s * ds, 0, 255).astype(np.uint8)
-    image = cv2.cvtColor(cv2.merge([h, s, v]), cv2.COLOR_HSV2BGR)
-    return image, annotations
+@lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def rotation_homography(height, width, angle):
+    image_center = (width / 2, height / 2)
+    rotation_mat = cv2.getRotationMatrix2D(image_center, angle, 1)
+    abs_cos = abs(rotation_mat[0, 0])
+    abs_sin = abs(rotation_mat[0, 1])
+    bound_w = int(height * abs_sin + width * abs_cos)
+    bound_h = int(height * abs_cos + width * abs_sin)
+    rotation_mat[0, 2] += bound_w / 2 - image_center[0]
+    rotation_mat[1, 2] += bound_h / 2 - image_center[1]
+    m = np.vstack([rotation_mat, [0, 0, 1]])
+    m.flags.writeable = False
+    return m, bound_h, bound_w
+
+
+def perspective_homography(height, width, dx1, dx2, dy1, dy2):
+    pts1 = np.float32([[0, 0], [width, 0], [0, height], [width, height]])
+    pts2 = np.float32([[dx1, dy1], [width-dx1, dy2], [dx2, height-dy1], [width-dx2, height-dy2]])
+    return cv2.getPerspectiveTransform(pts1, pts2)
+
+
+def flip_homography(height, width, flipdir="h", edges=False):
+    assert flipdir in ["h", "v"]
+    # Mirrors pixel indices exactly like cv2.flip does, or with edges=True the pixel edges box corners lie on,
+    # exactly like augmentate_flip mirrors the boxes
+    extent = (width, height) if edges else (width - 1, height - 1)
+    if flipdir == "h":
+        return np.array([[-1, 0, extent[0]], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+    return np.array([[1, 0, 0], [0, -1, extent[1]], [0, 0, 1]], dtype=np.float64)
+
+
+def shift_homography(tx, ty):
+    return np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]], dtype=np.float64)
+
+
+@lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def geometric_homography(height, width, angle=None, perspective=None, flipdir=None, shift=None, edges=False):
+    """
+    Composes rotation, perspective, flip and shift (in that order) into one homography
+    :param edges: Use this flag to get the homography of box corners, whose flip mirrors pixel edges
+    :return: 3x3 homography, read-only as it is cached, height and width of the output
+    """
+    out_h, out_w = height, width
+    m = np.eye(3)
+    if angle is not None:
+        rot, out_h, out_w = rotation_homography(height, width, angle)
+        m = rot @ m
+    if perspective is not None:
+        m = perspective_homography(out_h, out_w, *perspective) @ m
+    if flipdir is not None:
+        m = flip_homography(out_h, out_w, flipdir, edges) @ m
+    if shift is not None:
+        m = shift_homography(*shift) @ m
+    m.flags.writeable = False
+    return m, out_h, out_w
+
+
+def augmentate_geometric(image, annotations, angle=None, perspective=None, flipdir=None, shift=None,
+                         minobjsize=0.001, dst=None):
+    """
+    Applies rotation, perspective, flip and shift (in that order) with a single warp
+    :param image: Image to be transformed
+    :param annotations: YOLO format annotations of the image
+    :param angle: Rotation angle in degrees, or None to skip rotation
+    :param perspective: Tuple of (dx1, dx2, dy1, dy2) perspective offsets, or None to skip
+    :param flipdir: "h" or "v" flip direction, or None to skip
+    :param shift: Tuple of (tx, ty) shift in pixels, or None to skip
+    :param minobjsize: Minimum normalized width/height for a bounding box to be kept
+    :param dst: Optional preallocated output, of the size given by geometric_homography
+    :return: Transformed image and annotations
+    """
+    height, width = image.shape[:2]
+    m, out_h, out_w = geometric_homography(height, width, angle, perspective, flipdir, shift)
+
+    permutation = integer_permutation(m)
+    if permutation is not None:
+        warped = permute_pixels(image, permutation, out_h, out_w, dst)
+    else:
+        warped = cv2.warpPerspective(image, m, (out_w, out_h), dst=dst)
+
+    # Box corners are mirrored about the pixel edges, the pixels about their centers
+    if flipdir is not None:
+        m = geometric_homography(height, width, angle, perspective, flipdir, shift, edges=True)[0]
+    annotations = as_annotations(annotations)
+    new_rect = transform_corners(box_corners(yolotocv_array(annotations[:, 1:], height, width)), m)
+    new_corners = np.hstack([new_rect.min(axis=1), new_rect.max(axis=1)])
+    new_bbox = clip_boxes(annotations[:, 0], new_corners, out_h, out_w, minobjsize)
+
+    return warped, new_bbox
+
+
+def augmentate_hsv(image, annotations, dh, ds, dst=None):
+    return apply_photometric(image, [("hsv", (dh, ds))], dst), annotations
+
+
+def augmentate_contrast(image, annotations, gamma, dst=None):
+    return apply_photometric(image, [("contrast", (gamma,))], dst), annotations
+
+
+def augmentate_photometric(image, annotations, ops, dst=None):
+    return apply_photometric(image, ops, dst), annotations
+
+
+def augmentate_sharpness(image, annotations, size, sigma, dst=None, scratch=None):
+    # dst may be image itself, the blurred copy lives in scratch
+    blurred = cv2.GaussianBlur(image, (size, size), sigma, dst=scratch)
+    return cv2.addWeighted(image, 1.5, blurred, -0.5, 0, dst=dst), annotations
+
+
+def augmentate_sharpness_fast(image, annotations, size, sigma, dst=None, scratch=None):
+    blurred = fast_gaussian(image, size, size, sigma, dst=scratch)
+    return cv2.addWeighted(image, 1.5, blurred, -0.5, 0, dst=dst), annotations
+
+
+def augmentate_gaussianblur_batch(images, annotations, kws, khs, sigmas, fast=False):
+    # Kernels differ per sample, so each sample is blurred on its own straight into the output batch
+    blurred = np.empty_like(images)
+    for i in range(len(images)):
+        if fast:
+            fast_gaussian(images[i], kws[i], khs[i], sigmas[i], dst=blurred[i])
+        else:
+            cv2.GaussianBlur(images[i], (kws[i], khs[i]), sigmas[i], dst=blurred[i])
+    return blurred, annotations
+
+
+def augmentate_hsv_batch(images, annotations, dhs, dss):
+    return apply_photometric_batch(images, [[("hsv", (dh, ds))] for dh, ds in zip(dhs, dss)]), annotations
+
+
+def augmentate_contrast_batch(images, annotations, gammas):
+    return apply_photometric_batch(images, [[("contrast", (gamma,))] for gamma in gammas]), annotations
 
 
-def augmentate_contrast(image, annotations, gamma):
-    lut = []
-    for i in range(256):
-        lut.append((i / 255) ** gamma * 255)
-    lut = np.uint8(lut)
-    image = cv2.LUT(image, lut)
-    return image, annotations
+def augmentate_photometric_batch(images, annotations, ops_per_image):
+    return apply_photometric_batch(images, ops_per_image), annotations
 
 
-def augmentate_sharpness(image, annotations, size, sigma):
-    image = cv2.addWeighted(image, 1.5, cv2.GaussianBlur(image, (size, size), sigma), -0.5, 0, image)
-    return image, annotations
+def augmentate_saltnpeppernoise_batch(images, annotations, noise_intensities, rngs=None, copy=True):
+    images = images.copy() if copy else images
+    rngs = [None] * len(images) if rngs is None else rngs
+    for i in range(len(images)):
+        augmentate_saltnpeppernoise(images[i], None, noise_intensities[i], rng=rngs[i], copy=False)
+    return images, annotations
 
 
 def draw_annotations(starting_img, annotations_to_draw, col, thk):
     nh, nw = starting_img.shape[:2]
     drawn_img = starting_img
-    for a in annotations_to_draw:
-        obj, x, y, w, h = map(float, a)
-        x1, y1, x2, y2 = yolotocv(x, y, w, h, nh, nw)
+    for x1, y1, x2, y2 in yolotocv_array(as_annotations(annotations_to_draw)[:, 1:], nh, nw):
         p1 = (int(x1), int(y1))
         p2 = (int(x2), int(y2))
 
@@ -214,8 +435,7 @@ def main():
 
     # Load data
     img = cv2.imread(img_dir)
-    with open(ann_dir, "r") as f:
-        original_anns = [list(map(float, a.strip('\n').split(' '))) for a in f.readlines()]
+    original_anns = load_annotations(ann_dir)
 
     # Perform augmentations for testing
     if test_rotation: